@@ -13,20 +13,24 @@ export enum TranscriptionState {
   TRANSCRIBING = 'transcribing',
   POST_PROCESSING = 'post_processing',
   DONE = 'done',
+  FAILED = 'failed',
   CONVERTING = 'converting',
 }
 
 export interface TranscriptionTask extends Task {
   progress: number;
   state: TranscriptionState;
-  content?: V1Paragraph<Omit<V1V2Silence | V1V2Word, 'source'>>[];
+  error?: string;
 }
 
+export type TranscriptionResult = V1Paragraph<Omit<V1V2Silence | V1V2Word, 'source'>>[];
+
 export enum DownloadingModelState {
   QUEUED = 'queued',
   DOWNLOADING = 'downloading',
   EXTRACTING = 'extracting',
   DONE = 'done',
+  FAILED = 'failed',
 }
 
 export interface DownloadModelTask extends Task {
@@ -34,6 +38,7 @@ export interface DownloadModelTask extends Task {
   name: string;
   state: DownloadingModelState;
   progress: number;
+  error?: string;
 }
 
 export function startTranscription(
@@ -65,6 +70,13 @@ export function getTask<T extends Task>(server: ServerConfig, task: T): Promise<
   return fetchFromServer(server, 'GET', `tasks/${task.uuid}`).then((x) => x.json());
 }
 
+export function getTranscriptionResult(
+  server: ServerConfig,
+  task: TranscriptionTask
+): Promise<TranscriptionResult> {
+  return fetchFromServer(server, 'GET', `tasks/${task.uuid}/result`).then((x) => x.json());
+}
+
 export function deleteTask(server: ServerConfig, uuid: string): Promise<void> {
   return fetchFromServer(server, 'DELETE', `tasks/${uuid}`).then(() => {});
 }
@@ -67,9 +67,15 @@ export const downloadModel = createAsyncThunk<void, Model, { state: RootState }>
     const task = await downloadModelApiCall(server, model.model_id);
 
     while (true) {
-      const { state, progress } = await getTask(server, task);
+      const { state, progress, error } = await getTask(server, task);
 
       dispatch(setProgress({ model, state, progress, task_uuid: task.uuid }));
+      if (state == DownloadingModelState.FAILED) {
+        alert(`The download of ${model.name} failed: ${error}`);
+        await deleteTask(server, task.uuid).catch(() => undefined);
+        dispatch(fetchModelState());
+        break;
+      }
       if (state == DownloadingModelState.DONE) {
         dispatch(fetchModelState());
         break;
@@ -128,7 +134,7 @@ export const modelsSlice = createSlice({
     ) => {
       const { progress, state, model, task_uuid } = payload.payload;
 
-      if (state == DownloadingModelState.DONE) {
+      if (state == DownloadingModelState.DONE || state == DownloadingModelState.FAILED) {
         slice.downloading = slice.downloading.filter((x) => !(x.model_id == model.model_id));
         return;
       }
@@ -19,9 +19,10 @@ import { copyToMp4, convertToWav } from '../core/ffmpeg';
 import {
   deleteTask,
   getTask,
+  getTranscriptionResult,
   startTranscription as startTranscriptionApiCall,
+  TranscriptionResult,
   TranscriptionState,
-  TranscriptionTask,
 } from '../server_api/api';
 import { openFile } from '../../ipc/ipc_renderer';
 import { openDocumentFromMemory } from './editor/io';
@@ -115,11 +116,18 @@ export const startTranscription = createAsyncThunk<
     dispatch(setState(task.state));
 
     while (true) {
-      const { content, state, progress } = await getTask(server, task);
+      const { state, progress, error } = await getTask(server, task);
 
       dispatch(setProgress(progress));
       dispatch(setState(state));
 
+      if (state == 'failed') {
+        alert(`The transcription failed: ${error}`);
+        dispatch(openLanding());
+        await deleteTask(server, task.uuid).catch(() => undefined);
+        return;
+      }
+
       if (state == 'done') {
         const fileContent = readFileSync(path);
         const fileContents = fileContent.buffer;
@@ -148,6 +156,7 @@ export const startTranscription = createAsyncThunk<
           },
         };
 
+        const content = await getTranscriptionResult(server, task);
         const flatContent: V3DocumentItem[] = convertTranscriptionResultToV3Content(
           content,
           hashValue,
@@ -171,7 +180,7 @@ export const startTranscription = createAsyncThunk<
 );
 
 function convertTranscriptionResultToV3Content(
-  content: TranscriptionTask['content'],
+  content: TranscriptionResult | undefined,
   source: string,
   language: string
 ): V3DocumentItem[] {
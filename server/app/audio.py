@@ -0,0 +1,354 @@
+import audioop
+import os
+import shutil
+import subprocess
+import tempfile
+import uuid
+import warnings
+import wave
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import webrtcvad
+from pydub import AudioSegment
+from pydub.exceptions import CouldntDecodeError
+
+from .config import CACHE_DIR, FFMPEG, PCM_CACHE_DIR, PCM_CACHE_SIZE
+from .disk_cache import DiskCache
+from .metrics import count_decoded_bytes, measure
+
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+# Number of seconds of input audio that are decoded at once while streaming.
+# This bounds the memory used for decoding independently of the file length.
+DECODE_CHUNK_SIZE = 10
+# webrtcvad only accepts frames of 10, 20 or 30ms
+VAD_FRAME_LENGTH = 0.03
+# Aggressiveness of webrtcvad in filtering out non-speech, between 0 and 3
+VAD_MODE = 2
+# Minimum length of a pause in seconds that `find_pause` considers
+MIN_PAUSE_LENGTH = 0.3
+# Aggressiveness of webrtcvad when gating the recognizer. Lower than VAD_MODE,
+# skipping quiet speech loses words while decoding some noise only costs time
+VAD_GATING_MODE = 1
+# Minimum length of non-speech in seconds that `speech_ranges` leaves out
+MIN_SKIPPED_SILENCE = 1.0
+# Seconds of non-speech kept around speech, so words at its edges aren't cut off
+SPEECH_PADDING = 0.3
+# Bump this if the way audio is decoded changes, so audio decoded
+# the old way isn't used anymore
+PCM_CACHE_VERSION = 1
+
+
+class DecodeError(Exception):
+    pass
+
+
+class PcmBuffer:
+    """
+    Decoded 16kHz mono int16 audio in one contiguous, memory-mapped file.
+
+    Audio is decoded and resampled exactly once. Consumers then read
+    zero-copy views of the samples through `frames`.
+    """
+
+    def __init__(self, path: Path, delete: bool = True):
+        self.path = path
+        self.delete = delete
+        if path.stat().st_size > 0:
+            self.samples = np.memmap(path, dtype=np.int16, mode="r")
+        else:
+            # np.memmap refuses to map empty files
+            self.samples = np.zeros(0, dtype=np.int16)
+
+    @classmethod
+    def from_audio_segment(cls, audio: AudioSegment) -> "PcmBuffer":
+        with measure("resampling"):
+            audio = audio.set_frame_rate(SAMPLE_RATE)
+            audio = audio.set_channels(1)
+            audio = audio.set_sample_width(SAMPLE_WIDTH)
+        count_decoded_bytes(len(audio.raw_data))
+        fd, path = tempfile.mkstemp(suffix=".pcm", dir=CACHE_DIR)
+        with os.fdopen(fd, "wb") as f:
+            f.write(memoryview(audio.raw_data))
+        return cls(Path(path))
+
+    @classmethod
+    def from_chunks(cls, chunks: Iterable[bytes]) -> "PcmBuffer":
+        fd, path = tempfile.mkstemp(suffix=".pcm", dir=CACHE_DIR)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return cls(Path(path))
+
+    @property
+    def duration_seconds(self) -> float:
+        return len(self.samples) / SAMPLE_RATE
+
+    def sample_index(self, seconds: float) -> int:
+        return min(max(round(seconds * SAMPLE_RATE), 0), len(self.samples))
+
+    def frames(self, start: float, end: float) -> memoryview:
+        """Return the raw little-endian bytes between `start` and `end` seconds."""
+        view = self.samples[self.sample_index(start) : self.sample_index(end)]
+        return memoryview(view).cast("B")
+
+    def blocks(
+        self, start: float, duration: float, size: float
+    ) -> Iterator[memoryview]:
+        """Yield consecutive views of at most `size` seconds covering the range."""
+        start_index = self.sample_index(start)
+        end_index = self.sample_index(start + duration)
+        step = max(round(size * SAMPLE_RATE), 1)
+        while True:
+            block_end = min(start_index + step, end_index)
+            yield memoryview(self.samples[start_index:block_end]).cast("B")
+            if block_end >= end_index:
+                break
+            start_index = block_end
+
+    def close(self):
+        # dropping the last reference unmaps the file
+        self.samples = np.zeros(0, dtype=np.int16)
+        if self.delete:
+            try:
+                self.path.unlink(missing_ok=True)
+            except OSError:
+                # on windows a file that is still open under another name
+                # (see `PcmCache.put`) can't be deleted
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def speech_frames(
+    pcm: PcmBuffer, start: float, end: float, mode: int = VAD_MODE
+) -> np.ndarray:
+    """Return a bool per VAD_FRAME_LENGTH frame between `start` and `end`"""
+    vad = webrtcvad.Vad(mode)
+    frame_length = round(VAD_FRAME_LENGTH * SAMPLE_RATE)
+    samples = pcm.samples[pcm.sample_index(start) : pcm.sample_index(end)]
+    frame_count = len(samples) // frame_length
+    return np.fromiter(
+        (
+            vad.is_speech(
+                samples[i * frame_length : (i + 1) * frame_length].tobytes(),
+                SAMPLE_RATE,
+            )
+            for i in range(frame_count)
+        ),
+        dtype=bool,
+        count=frame_count,
+    )
+
+
+def find_pause(pcm: PcmBuffer, start: float, end: float) -> Optional[float]:
+    """Return the center of the longest pause between `start` and `end`, if any"""
+    start = max(start, 0)
+    is_speech = speech_frames(pcm, start, end)
+    # pad with speech so every pause has a start and an end edge
+    edges = np.diff(np.concatenate(([True], is_speech, [True])).astype(np.int8))
+    pause_starts = np.flatnonzero(edges == -1)
+    pause_ends = np.flatnonzero(edges == 1)
+    if len(pause_starts) == 0:
+        return None
+    lengths = pause_ends - pause_starts
+    longest = np.argmax(lengths)
+    if lengths[longest] * VAD_FRAME_LENGTH < MIN_PAUSE_LENGTH:
+        return None
+    center = (pause_starts[longest] + pause_ends[longest]) / 2
+    return start + center * VAD_FRAME_LENGTH
+
+
+def speech_ranges(
+    pcm: PcmBuffer, start: float, end: float, mode: int = VAD_GATING_MODE
+) -> List[Tuple[float, float]]:
+    """
+    Return the (start, end) ranges between `start` and `end` that contain speech,
+    padded by SPEECH_PADDING. Non-speech shorter than MIN_SKIPPED_SILENCE is
+    kept inside the ranges.
+    """
+    is_speech = speech_frames(pcm, start, end, mode)
+    # pad with non-speech so every speech run has a start and an end edge
+    edges = np.diff(np.concatenate(([False], is_speech, [False])).astype(np.int8))
+    ranges: List[Tuple[float, float]] = []
+    for speech_start, speech_end in zip(
+        np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    ):
+        range_start = max(
+            start + speech_start * VAD_FRAME_LENGTH - SPEECH_PADDING, start
+        )
+        range_end = min(start + speech_end * VAD_FRAME_LENGTH + SPEECH_PADDING, end)
+        if range_start - (ranges[-1][1] if ranges else start) < MIN_SKIPPED_SILENCE:
+            range_start = ranges.pop()[0] if ranges else start
+        ranges.append((range_start, range_end))
+    # the frames don't cover the last few ms, so don't end right before them
+    if ranges and end - ranges[-1][1] < MIN_SKIPPED_SILENCE:
+        ranges[-1] = (ranges[-1][0], end)
+    return ranges
+
+
+class WavStream:
+    """
+    Incrementally decodes a PCM wav file to 16kHz mono int16.
+
+    Only the header is read on construction, so the duration is known
+    before any audio is decoded. Raises `wave.Error` for files the
+    `wave` module can't handle (e.g. compressed or float wav files).
+    """
+
+    def __init__(self, file: BinaryIO):
+        self.wav = wave.open(file, "rb")
+        self.channels = self.wav.getnchannels()
+        self.sample_width = self.wav.getsampwidth()
+        self.frame_rate = self.wav.getframerate()
+
+    @property
+    def duration_seconds(self) -> float:
+        return self.wav.getnframes() / self.frame_rate
+
+    def chunks(self, size: float = DECODE_CHUNK_SIZE) -> Iterator[bytes]:
+        frames_per_chunk = max(int(size * self.frame_rate), 1)
+        ratecv_state = None
+        while True:
+            data = self.wav.readframes(frames_per_chunk)
+            if not data:
+                break
+            with measure("resampling"):
+                if self.sample_width == 1:
+                    # 8 bit wav files are unsigned, audioop expects signed samples
+                    data = audioop.bias(data, 1, -128)
+                if self.sample_width != SAMPLE_WIDTH:
+                    data = audioop.lin2lin(data, self.sample_width, SAMPLE_WIDTH)
+                if self.channels > 1:
+                    samples = np.frombuffer(data, dtype=np.int16)
+                    samples = samples.reshape(-1, self.channels).mean(axis=1)
+                    data = samples.astype(np.int16).tobytes()
+                if self.frame_rate != SAMPLE_RATE:
+                    data, ratecv_state = audioop.ratecv(
+                        data,
+                        SAMPLE_WIDTH,
+                        1,
+                        self.frame_rate,
+                        SAMPLE_RATE,
+                        ratecv_state,
+                    )
+            count_decoded_bytes(len(data))
+            yield data
+
+
+def ffmpeg_chunks(path: Path, size: float = DECODE_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Decode the first audio stream of any file ffmpeg understands to 16kHz mono
+    int16 in chunks of `size` seconds. ffmpeg writes the samples to a pipe,
+    so at most one chunk is held in memory. Raises `DecodeError` if ffmpeg fails.
+    """
+    command = [
+        FFMPEG,
+        "-nostdin",
+        "-v",
+        "error",
+        "-i",
+        str(path),
+        "-vn",
+        "-ac",
+        "1",
+        "-ar",
+        str(SAMPLE_RATE),
+        "-f",
+        "s16le",
+        "-",
+    ]
+    chunk_size = max(int(size * SAMPLE_RATE), 1) * SAMPLE_WIDTH
+    # ffmpeg may write a lot of errors for broken files, a pipe that nobody
+    # reads while we read the samples would block it
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            # don't open a console window for ffmpeg on windows
+            creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0),
+        )
+        try:
+            while True:
+                data = process.stdout.read(chunk_size)
+                if not data:
+                    break
+                count_decoded_bytes(len(data))
+                yield data
+            if process.wait() != 0:
+                stderr.seek(0)
+                message = stderr.read().decode(errors="replace").strip()
+                raise DecodeError(f"ffmpeg can't decode {path.name}: {message}")
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+
+
+def decode_file(path: Path, file_name: Optional[str] = None) -> PcmBuffer:
+    """
+    Decode any file ffmpeg understands to a `PcmBuffer`. Without ffmpeg,
+    only the wav flavours pydub can read itself are supported.
+    `file_name` is the name the file was uploaded with, for error messages.
+    """
+    if shutil.which(FFMPEG) is not None:
+        return PcmBuffer.from_chunks(ffmpeg_chunks(path))
+    extension = Path(file_name or path.name).suffix.lstrip(".").lower()
+    with open(path, "rb") as f:
+        header = f.read(12)
+    if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        raise DecodeError(f"ffmpeg is required to decode {extension or 'these'} files")
+    with warnings.catch_warnings():
+        # we ignore the warning that ffmpeg is not found as we
+        # don't need ffmpeg to decode wav files
+        warnings.filterwarnings("ignore", ".*ffmpeg.*")
+        try:
+            audio = AudioSegment.from_wav(path)
+        except (OSError, CouldntDecodeError) as e:
+            # pydub calls ffprobe for wav flavours it can't read itself
+            raise DecodeError("ffmpeg is required to decode this wav file") from e
+    return PcmBuffer.from_audio_segment(audio)
+
+
+class PcmCache(DiskCache):
+    """
+    Decoded audio of uploaded files, stored as raw 16kHz mono int16 samples.
+    Cached audio is mapped into memory directly instead of being copied.
+    """
+
+    suffix = ".pcm"
+
+    def read(self, file: BinaryIO):
+        return PcmBuffer(Path(file.name), delete=False)
+
+    def write(self, file: BinaryIO, value: PcmBuffer):
+        file.write(memoryview(value.samples).cast("B"))
+
+    def put(self, key: str, value: PcmBuffer):
+        if self.max_size <= 0:
+            return
+        # Decoded audio is spooled to a file next to the cache, so the cache entry
+        # becomes a second name of that file instead of another copy of the audio.
+        tmp_path = self.directory / f"{uuid.uuid4()}.tmp"
+        try:
+            os.link(value.path, tmp_path)
+        except OSError:
+            # e.g. a cache directory on another file system
+            super().put(key, value)
+            return
+        self._insert(key, tmp_path)
+
+
+pcm_cache = PcmCache(PCM_CACHE_DIR, PCM_CACHE_SIZE)
@@ -12,3 +12,111 @@ CACHE_DIR = Path(
     os.environ.get("AUDAPOLIS_CACHE_DIR", appdirs.user_cache_dir("audapolis"))
 )
 CACHE_DIR.mkdir(exist_ok=True, parents=True)
+
+# Partial model downloads, kept so that interrupted downloads can be resumed
+DOWNLOAD_DIR = CACHE_DIR / "downloads"
+# Uploaded files of transcriptions that haven't finished yet
+UPLOAD_DIR = DATA_DIR / "uploads"
+UPLOAD_DIR.mkdir(exist_ok=True)
+
+# How diarized speaker segments are transcribed in parallel: "thread" runs them
+# in threads of the server process, "process" in a pool of worker processes
+# that each load the transcription model once.
+TRANSCRIPTION_EXECUTOR = os.environ.get("AUDAPOLIS_TRANSCRIPTION_EXECUTOR", "thread")
+if TRANSCRIPTION_EXECUTOR not in ("thread", "process"):
+    raise ValueError(
+        f"AUDAPOLIS_TRANSCRIPTION_EXECUTOR must be 'thread' or 'process', "
+        f"not {TRANSCRIPTION_EXECUTOR!r}"
+    )
+
+# How diarized transcriptions are run: "sequential" diarizes the audio first and
+# then transcribes each speaker segment, "pipelined" transcribes the whole audio
+# while it is diarized and assigns the words to the speakers afterwards
+DIARIZATION_MODE = os.environ.get("AUDAPOLIS_DIARIZATION_MODE", "sequential")
+if DIARIZATION_MODE not in ("sequential", "pipelined"):
+    raise ValueError(
+        f"AUDAPOLIS_DIARIZATION_MODE must be 'sequential' or 'pipelined', "
+        f"not {DIARIZATION_MODE!r}"
+    )
+
+# Whether non-speech is skipped before the recognizer: "on" finds speech with a
+# voice activity detector and only decodes that, "off" decodes all audio
+VAD_GATING = os.environ.get("AUDAPOLIS_VAD_GATING", "off")
+if VAD_GATING not in ("on", "off"):
+    raise ValueError(f"AUDAPOLIS_VAD_GATING must be 'on' or 'off', not {VAD_GATING!r}")
+
+# Number of parallel transcription workers, defaults to a value based on the cpu count
+TRANSCRIPTION_WORKERS = (
+    int(os.environ["AUDAPOLIS_TRANSCRIPTION_WORKERS"])
+    if "AUDAPOLIS_TRANSCRIPTION_WORKERS" in os.environ
+    else None
+)
+
+# Transcriptions without diarization are split into chunks of roughly this many
+# seconds, which are transcribed in parallel. Set to 0 to disable chunking.
+TRANSCRIPTION_CHUNK_LENGTH = float(
+    os.environ.get("AUDAPOLIS_TRANSCRIPTION_CHUNK_LENGTH", 120)
+)
+
+# Number of transcriptions that run at the same time, further ones are queued
+SCHEDULER_WORKERS = int(os.environ.get("AUDAPOLIS_SCHEDULER_WORKERS", 2))
+# Number of queued transcriptions after which new ones are rejected
+SCHEDULER_MAX_QUEUE = int(os.environ.get("AUDAPOLIS_SCHEDULER_MAX_QUEUE", 100))
+# Queued transcriptions are held back while less memory (in MiB) is available
+SCHEDULER_MIN_FREE_MEMORY = (
+    int(os.environ.get("AUDAPOLIS_SCHEDULER_MIN_FREE_MEMORY", 1024)) * 1024 * 1024
+)
+
+# Loaded models are evicted from memory if their total size (in MiB)
+# exceeds this budget, least recently used first
+MODEL_CACHE_SIZE = int(os.environ.get("AUDAPOLIS_MODEL_CACHE_SIZE", 4096)) * 1024 * 1024
+# Loaded models that haven't been used for this many seconds are evicted,
+# 0 disables the idle eviction
+MODEL_IDLE_TIMEOUT = float(os.environ.get("AUDAPOLIS_MODEL_IDLE_TIMEOUT", 30 * 60))
+
+# Comma separated ids of models that are loaded in the background on startup
+PRELOAD_MODELS = [
+    model_id.strip()
+    for model_id in os.environ.get("AUDAPOLIS_PRELOAD_MODELS", "").split(",")
+    if model_id.strip()
+]
+
+# Number of parallel range requests used to download a model
+DOWNLOAD_CONNECTIONS = int(os.environ.get("AUDAPOLIS_DOWNLOAD_CONNECTIONS", 4))
+
+# Where tasks are persisted: "sqlite" stores them in DATA_DIR so they survive
+# restarts of the server, "memory" doesn't persist them at all
+TASK_STORE = os.environ.get("AUDAPOLIS_TASK_STORE", "sqlite")
+TASK_STORE_PATH = DATA_DIR / "tasks.sqlite3"
+# Changes to tasks are written to the task store every this many seconds
+TASK_STORE_FLUSH_INTERVAL = float(
+    os.environ.get("AUDAPOLIS_TASK_STORE_FLUSH_INTERVAL", 2)
+)
+# Results of finished tasks that weren't fetched for this many seconds are only
+# kept in the task store and loaded from it again when needed. 0 keeps them in memory
+RESULT_TTL = float(os.environ.get("AUDAPOLIS_RESULT_TTL", 600))
+
+# Finished transcriptions are cached by the hash of their audio and their
+# parameters, so transcribing the same file again returns immediately.
+# Least recently used results are deleted above this size in MiB, 0 disables the cache
+RESULT_CACHE_DIR = CACHE_DIR / "results"
+RESULT_CACHE_SIZE = (
+    int(os.environ.get("AUDAPOLIS_RESULT_CACHE_SIZE", 512)) * 1024 * 1024
+)
+
+# MFCC features of diarized audio are cached by the hash of the audio, so
+# diarizing it again is faster. Least recently used features are deleted
+# above this size in MiB, 0 disables the cache
+FEATURE_CACHE_DIR = CACHE_DIR / "features"
+FEATURE_CACHE_SIZE = (
+    int(os.environ.get("AUDAPOLIS_FEATURE_CACHE_SIZE", 1024)) * 1024 * 1024
+)
+
+# Decoded audio is cached by the hash of the uploaded file, so transcribing
+# it again (e.g. with another model) doesn't decode it again. Least recently
+# used audio is deleted above this size in MiB, 0 disables the cache
+PCM_CACHE_DIR = CACHE_DIR / "pcm"
+PCM_CACHE_SIZE = int(os.environ.get("AUDAPOLIS_PCM_CACHE_SIZE", 2048)) * 1024 * 1024
+
+# The ffmpeg executable that decodes uploaded files that aren't PCM wav files
+FFMPEG = os.environ.get("AUDAPOLIS_FFMPEG", "ffmpeg")
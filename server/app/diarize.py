@@ -0,0 +1,183 @@
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from pydiar.models import BinaryKeyDiarizationModel, Segment
+from pydiar.models.binary_key.diarizationFunctions import getSegments, getSegmentTable
+from python_speech_features.base import get_filterbanks, lifter
+from scipy.fftpack import dct
+
+from .audio import SAMPLE_RATE, VAD_FRAME_LENGTH, PcmBuffer, speech_frames
+from .config import FEATURE_CACHE_DIR, FEATURE_CACHE_SIZE
+from .disk_cache import DiskCache
+from .metrics import measure
+
+# Bump this if the feature extraction changes, so cached features are recomputed
+FEATURE_CACHE_VERSION = 1
+# Number of feature frames that are computed at once. This bounds the memory
+# used by the feature extraction independently of the file length.
+FEATURE_BLOCK_SIZE = 10000
+# Aggressiveness of the VAD in front of the diarization, the same pydiar uses
+DIARIZATION_VAD_MODE = 0
+PREEMPHASIS = 0.97
+
+
+class FeatureCache(DiskCache):
+    """MFCC features and speech masks of audio files, stored as npz files"""
+
+    suffix = ".npz"
+
+    def read(self, file):
+        with np.load(file) as data:
+            return data["features"], data["mask"]
+
+    def write(self, file, value):
+        features, mask = value
+        np.savez(file, features=features, mask=mask)
+
+
+feature_cache = FeatureCache(FEATURE_CACHE_DIR, FEATURE_CACHE_SIZE)
+
+
+class Diarizer(BinaryKeyDiarizationModel):
+    """
+    BinaryKeyDiarizationModel with a faster front-end.
+
+    The MFCC features are computed block-wise from the memory-mapped samples,
+    instead of framing the whole file at once, and the VAD mask is derived
+    from `speech_frames`. Features and masks are cached by the hash of the
+    audio, so diarizing the same audio again starts at the clustering.
+    Diarizers don't keep state between calls and can be shared by threads.
+    """
+
+    def __init__(self, max_speakers: Optional[int] = None):
+        super().__init__()
+        if max_speakers is not None:
+            self.CLUSTERING_SELECTION_MAX_SPEAKERS = max_speakers
+
+    def features(
+        self, pcm: PcmBuffer, source_hash: Optional[str] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the MFCC features and the speech mask of the audio"""
+        key = f"{source_hash}-{FEATURE_CACHE_VERSION}"
+        if source_hash is not None:
+            cached = feature_cache.get(key)
+            if cached is not None:
+                return cached
+
+        features = self._extract_features(SAMPLE_RATE, pcm.samples)
+        is_speech = speech_frames(
+            pcm, 0, pcm.duration_seconds, mode=DIARIZATION_VAD_MODE
+        )
+        frames_per_vad_frame = round(VAD_FRAME_LENGTH / self.FRAMESHIFT)
+        mask = np.zeros(len(features))
+        speech = np.repeat(is_speech, frames_per_vad_frame)[: len(features)]
+        mask[: len(speech)] = speech
+
+        if source_hash is not None:
+            feature_cache.put(key, (features, mask))
+        return features, mask
+
+    def _extract_features(self, sample_rate, signal):
+        # the same features as python_speech_features.mfcc with the parameters
+        # pydiar uses, but without materializing all frames at once
+        frame_length = int(self.FRAMELENGTH * sample_rate + 0.5)
+        frame_shift = int(self.FRAMESHIFT * sample_rate + 0.5)
+        n_fft = int(2 ** np.ceil(np.log2(self.FRAMELENGTH * sample_rate)))
+        filterbanks = get_filterbanks(
+            self.NFILTERS, n_fft, sample_rate, lowfreq=20, highfreq=7600
+        ).T
+
+        frame_count = 1
+        if len(signal) > frame_length:
+            frame_count += int(np.ceil((len(signal) - frame_length) / frame_shift))
+        features = np.empty((frame_count, self.NCOEFF))
+
+        for first in range(0, frame_count, FEATURE_BLOCK_SIZE):
+            last = min(first + FEATURE_BLOCK_SIZE, frame_count)
+            start = first * frame_shift
+            end = (last - 1) * frame_shift + frame_length
+            samples = signal[start:end].astype(np.float64)
+            emphasized = np.zeros(end - start)
+            emphasized[: len(samples)] = samples
+            emphasized[1 : len(samples)] -= PREEMPHASIS * samples[:-1]
+            if start > 0:
+                emphasized[0] -= PREEMPHASIS * signal[start - 1]
+
+            frames = sliding_window_view(emphasized, frame_length)[::frame_shift]
+            spectrum = np.square(np.abs(np.fft.rfft(frames, n_fft))) / n_fft
+            eps = np.finfo(float).eps
+            energy = np.maximum(spectrum.sum(axis=1), eps)
+            energies = np.maximum(spectrum @ filterbanks, eps)
+            cepstra = dct(np.log(energies), type=2, axis=1, norm="ortho")
+            cepstra = lifter(cepstra[:, : self.NCOEFF])
+            cepstra[:, 0] = np.log(energy)
+            features[first:last] = cepstra
+
+        return features
+
+    def diarize_pcm(
+        self, pcm: PcmBuffer, source_hash: Optional[str] = None
+    ) -> List[Segment]:
+        """
+        Diarize the audio like `diarize` does, using the cached features.
+        Each stage is measured as a phase of its own, see `measure`.
+        """
+        # A. Preprocessing
+        with measure("diarization_features"):
+            features, mask = self.features(pcm, source_hash)
+            segment_table = getSegmentTable(
+                mask, self.SEGMENT_LENGTH, self.SEGMENT_SHIFT, self.SEGMENT_LENGTH
+            )
+            masked_features = features[np.where(mask == 1)]
+        if len(masked_features) == 0:
+            return []
+
+        speech_mapping = np.zeros(len(features))
+        speech_mapping[np.nonzero(mask)] = np.arange(1, len(masked_features) + 1)
+
+        # B. Acoustic Processing
+        with measure("diarization_binary_keys"):
+            (
+                segmentBKTable,
+                segmentCVTable,
+                kbm_size,
+                initialClustering,
+                Vg,
+            ) = self._acousting_processing(
+                masked_features, segment_table, speech_mapping
+            )
+
+        # C. AHC
+        with measure("diarization_clustering"):
+            best_clustering = self._binary_processing(
+                speech_mapping,
+                segment_table,
+                segmentBKTable,
+                segmentCVTable,
+                Vg,
+                kbm_size,
+                initialClustering,
+            )
+
+        # D. Resegmentation
+        with measure("diarization_resegmentation"):
+            best_clustering, segment_table = self._resegmentation(
+                masked_features, speech_mapping, mask, best_clustering, segment_table
+            )
+            segments = getSegments(
+                self.FRAMESHIFT, segment_table, np.squeeze(best_clustering, 1)
+            )
+        return [Segment(*x) for x in segments]
+
+
+_diarizers: Dict[Optional[int], Diarizer] = {}
+_diarizers_lock = threading.Lock()
+
+
+def get_diarizer(max_speakers: Optional[int] = None) -> Diarizer:
+    with _diarizers_lock:
+        if max_speakers not in _diarizers:
+            _diarizers[max_speakers] = Diarizer(max_speakers)
+        return _diarizers[max_speakers]
@@ -0,0 +1,85 @@
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import BinaryIO, Dict, Tuple
+
+
+class DiskCache:
+    """
+    Values stored as files with the name `<key><suffix>` in `directory`.
+
+    If the files take up more than `max_size` bytes, the least recently used
+    ones are deleted. A `max_size` of 0 disables the cache. Subclasses define
+    how values are stored by implementing `read` and `write`.
+    """
+
+    suffix = ""
+
+    def __init__(self, directory: Path, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # key -> (size, last use) of the files in the cache
+        self.entries: Dict[str, Tuple[int, float]] = {}
+        if max_size > 0:
+            directory.mkdir(exist_ok=True, parents=True)
+            for path in directory.glob(f"*{self.suffix}"):
+                stat = path.stat()
+                key = path.name[: -len(self.suffix)]
+                self.entries[key] = (stat.st_size, stat.st_mtime)
+
+    def read(self, file: BinaryIO):
+        raise NotImplementedError()
+
+    def write(self, file: BinaryIO, value):
+        raise NotImplementedError()
+
+    def path(self, key: str) -> Path:
+        return self.directory / f"{key}{self.suffix}"
+
+    def get(self, key: str):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            size, _ = self.entries[key]
+            self.entries[key] = (size, time.time())
+        try:
+            with open(self.path(key), "rb") as f:
+                value = self.read(f)
+            # the mtime is the last use when the cache is restored
+            os.utime(self.path(key))
+        except (OSError, ValueError):
+            with self.lock:
+                self.entries.pop(key, None)
+            return None
+        return value
+
+    def put(self, key: str, value):
+        if self.max_size <= 0:
+            return
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            self.write(f, value)
+        self._insert(key, Path(tmp_path))
+
+    def _insert(self, key: str, tmp_path: Path):
+        """Move the complete file at `tmp_path` into the cache as `key`"""
+        os.replace(tmp_path, self.path(key))
+        with self.lock:
+            self.entries[key] = (self.path(key).stat().st_size, time.time())
+            self._evict()
+
+    def _evict(self):
+        total = sum(size for size, _ in self.entries.values())
+        for key, (size, _) in sorted(self.entries.items(), key=lambda x: x[1][1]):
+            if total <= self.max_size:
+                break
+            try:
+                self.path(key).unlink(missing_ok=True)
+            except OSError:
+                # on windows files that are still open can't be deleted
+                continue
+            del self.entries[key]
+            total -= size
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+import requests
+
+from .config import DOWNLOAD_CONNECTIONS
+
+# Downloads smaller than this aren't split into parallel range requests
+MIN_PARALLEL_SIZE = 16 * 1024 * 1024
+# Number of bytes after which the download state is written to disk
+SAVE_INTERVAL = 8 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+RETRIES = 5
+TIMEOUT = 30
+
+
+class DownloadError(Exception):
+    pass
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class PartialDownload:
+    """
+    Download of a url into a file that can be resumed after cancellation,
+    connection errors or a restart of the server.
+
+    If the server supports range requests, the file is fetched as several
+    ranges in parallel. The bytes fetched for each range are persisted in a
+    json file next to the download, so a later download of the same url only
+    fetches the missing parts.
+    """
+
+    def __init__(self, url: str, path: Path):
+        self.url = url
+        self.path = path
+        self.state_path = Path(f"{path}.json")
+        self.lock = threading.Lock()
+        self.state: Optional[dict] = None
+
+    def fetch(self, task, connections: int = DOWNLOAD_CONNECTIONS):
+        """
+        Fetch all missing bytes, reporting progress through `task.add_progress`.
+
+        Returns early if `task.canceled` is set, the partial download is kept.
+        """
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.state = self._load_state()
+        if self.state is None:
+            total, ranges_supported = self._probe()
+            if total is None or not ranges_supported:
+                # without ranges we can't resume, so fall back to a single stream
+                self._fetch_whole(task)
+                return
+            if total < MIN_PARALLEL_SIZE:
+                connections = 1
+            bounds = [total * i // connections for i in range(connections + 1)]
+            # each range is [start, end, number of bytes already on disk]
+            self.state = {
+                "url": self.url,
+                "total": total,
+                "ranges": [[start, end, 0] for start, end in zip(bounds, bounds[1:])],
+            }
+            with open(self.path, "wb") as f:
+                f.truncate(total)
+            self._save_state()
+
+        task.total = self.state["total"]
+        task.processed = 0
+        task.add_progress(sum(fetched for _, _, fetched in self.state["ranges"]))
+        ranges: List[list] = self.state["ranges"]
+        with ThreadPoolExecutor(len(ranges)) as executor:
+            list(executor.map(lambda range: self._fetch_range(range, task), ranges))
+
+    @property
+    def complete(self) -> bool:
+        if self.state is None:
+            return self.path.exists()
+        return all(
+            start + fetched >= end for start, end, fetched in self.state["ranges"]
+        )
+
+    def sha256(self) -> str:
+        hash = hashlib.sha256()
+        with open(self.path, "rb") as f:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+                hash.update(block)
+        return hash.hexdigest()
+
+    def discard(self):
+        self.path.unlink(missing_ok=True)
+        self.state_path.unlink(missing_ok=True)
+
+    def _probe(self):
+        response = requests.head(self.url, allow_redirects=True, timeout=TIMEOUT)
+        response.raise_for_status()
+        total = response.headers.get("content-length")
+        ranges_supported = response.headers.get("accept-ranges") == "bytes"
+        return int(total) if total else None, ranges_supported
+
+    def _load_state(self) -> Optional[dict]:
+        if not self.path.exists() or not self.state_path.exists():
+            return None
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get("url") != self.url:
+            return None
+        return state
+
+    def _save_state(self):
+        tmp_path = Path(f"{self.state_path}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f)
+        tmp_path.replace(self.state_path)
+
+    def _fetch_whole(self, task):
+        self.state_path.unlink(missing_ok=True)
+        response = requests.get(self.url, stream=True, timeout=TIMEOUT)
+        response.raise_for_status()
+        task.total = int(response.headers.get("content-length", 0))
+        task.processed = 0
+        with open(self.path, "wb") as f:
+            for data in response.iter_content(chunk_size=CHUNK_SIZE):
+                task.add_progress(len(data))
+                f.write(data)
+                if task.canceled:
+                    break
+        if task.canceled:
+            self.discard()
+
+    def _fetch_range(self, range: list, task):
+        start, end, _ = range
+        retries = 0
+        while start + range[2] < end and not task.canceled:
+            position = start + range[2]
+            unsaved = 0
+            try:
+                response = requests.get(
+                    self.url,
+                    headers={"Range": f"bytes={position}-{end - 1}"},
+                    stream=True,
+                    timeout=TIMEOUT,
+                )
+                with response, open(self.path, "r+b") as f:
+                    if response.status_code != 206:
+                        raise DownloadError(
+                            f"Server answered range request with {response.status_code}"
+                        )
+                    f.seek(position)
+                    for data in response.iter_content(chunk_size=CHUNK_SIZE):
+                        data = data[: end - position]
+                        f.write(data)
+                        position += len(data)
+                        unsaved += len(data)
+                        task.add_progress(len(data))
+                        if unsaved >= SAVE_INTERVAL or position >= end or task.canceled:
+                            # only record bytes as fetched once they are on disk
+                            f.flush()
+                            with self.lock:
+                                range[2] += unsaved
+                                self._save_state()
+                            unsaved = 0
+                        if position >= end or task.canceled:
+                            break
+                with self.lock:
+                    range[2] += unsaved
+                    self._save_state()
+                retries = 0
+            except requests.RequestException:
+                # the file was closed, so everything we got so far is on disk
+                with self.lock:
+                    range[2] += unsaved
+                    self._save_state()
+                retries += 1
+                if retries > RETRIES:
+                    raise
+                time.sleep(2**retries)
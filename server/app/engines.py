@@ -0,0 +1,204 @@
+import importlib.util
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Type
+
+import numpy as np
+from vosk import KaldiRecognizer, Model, _ffi
+
+from .audio import SAMPLE_RATE, SAMPLE_WIDTH
+
+# Seconds of audio whisper transcribes at once
+WHISPER_WINDOW = 30
+
+
+class EngineNotAvailable(Exception):
+    pass
+
+
+class Recognizer:
+    """
+    Recognizes one stream of 16kHz mono int16 audio.
+
+    Words are dicts with "word", "start", "end" (in seconds since the start of
+    the stream) and "conf" keys, the shape `transform_vosk_result` expects.
+    """
+
+    def accept(self, block: bytes) -> Optional[List[dict]]:
+        """Feed `block`, return the words of an utterance if one ended"""
+        raise NotImplementedError()
+
+    def partial(self) -> Tuple[str, Optional[List[dict]]]:
+        """The text and, if known, the words of the unfinished utterance"""
+        raise NotImplementedError()
+
+    def finish(self) -> List[dict]:
+        """End the stream and return the words of the last utterance"""
+        raise NotImplementedError()
+
+
+class EngineModel:
+    """A loaded model of a speech recognition engine"""
+
+    def __init__(self, path: Path, options: dict):
+        raise NotImplementedError()
+
+    @classmethod
+    def available(cls) -> bool:
+        """Whether the optional dependencies of the engine are installed"""
+        return True
+
+    def recognizer(self) -> Recognizer:
+        raise NotImplementedError()
+
+    def warm_up(self):
+        # decode a bit of silence so the first transcription doesn't pay for
+        # lazy initialization and pages of the model that aren't in memory yet
+        recognizer = self.recognizer()
+        recognizer.accept(bytes(SAMPLE_RATE * SAMPLE_WIDTH))
+        recognizer.finish()
+
+
+class VoskRecognizer(Recognizer):
+    def __init__(self, model: Model):
+        self.rec = KaldiRecognizer(model, SAMPLE_RATE)
+        self.rec.SetWords(True)
+        if hasattr(self.rec, "SetPartialWords"):
+            # only available in newer vosk versions
+            self.rec.SetPartialWords(True)
+
+    def accept(self, block: bytes) -> Optional[List[dict]]:
+        # hand vosk a pointer to the block instead of a copy
+        if self.rec.AcceptWaveform(_ffi.from_buffer(block)):
+            return json.loads(self.rec.Result()).get("result", [])
+        return None
+
+    def partial(self) -> Tuple[str, Optional[List[dict]]]:
+        result = json.loads(self.rec.PartialResult())
+        return result.get("partial", ""), result.get("partial_result")
+
+    def finish(self) -> List[dict]:
+        return json.loads(self.rec.FinalResult()).get("result", [])
+
+
+class VoskModel(EngineModel):
+    def __init__(self, path: Path, options: dict):
+        self.model = Model(str(path))
+
+    def recognizer(self) -> Recognizer:
+        return VoskRecognizer(self.model)
+
+
+class WhisperRecognizer(Recognizer):
+    """
+    Whisper doesn't recognize streams, so audio is buffered and transcribed
+    once a whole window is buffered. All segments but the last one are final.
+    The last one may be cut off, so its audio is transcribed again together
+    with the following audio.
+    """
+
+    def __init__(self, model: "WhisperModel"):
+        self.model = model
+        self.buffer = bytearray()
+        # seconds of audio before the start of the buffer
+        self.offset = 0.0
+
+    def accept(self, block: bytes) -> Optional[List[dict]]:
+        self.buffer += block
+        if len(self.buffer) < WHISPER_WINDOW * SAMPLE_RATE * SAMPLE_WIDTH:
+            return None
+        segments = self.model.transcribe(self.buffer)
+        if len(segments) > 1 and segments[-1].start > 0:
+            keep = segments.pop().start
+        else:
+            keep = len(self.buffer) / (SAMPLE_RATE * SAMPLE_WIDTH)
+        words = self._words(segments)
+        dropped = round(keep * SAMPLE_RATE) * SAMPLE_WIDTH
+        del self.buffer[:dropped]
+        self.offset += dropped / (SAMPLE_RATE * SAMPLE_WIDTH)
+        return words
+
+    def partial(self) -> Tuple[str, Optional[List[dict]]]:
+        return "", None
+
+    def finish(self) -> List[dict]:
+        words = self._words(self.model.transcribe(self.buffer)) if self.buffer else []
+        self.offset += len(self.buffer) / (SAMPLE_RATE * SAMPLE_WIDTH)
+        self.buffer.clear()
+        return words
+
+    def _words(self, segments) -> List[dict]:
+        return [
+            {
+                "word": word.word.strip(),
+                "start": self.offset + word.start,
+                "end": self.offset + word.end,
+                "conf": word.probability,
+            }
+            for segment in segments
+            for word in segment.words or []
+            if word.word.strip()
+        ]
+
+
+class WhisperModel(EngineModel):
+    """
+    A CTranslate2 model of faster-whisper, running on the cpu.
+
+    Options from models.yml: `language` (e.g. "en"), `compute_type` (defaults
+    to "int8"), `beam_size`, `cpu_threads` and `num_workers`, the number of
+    transcriptions that can run in parallel.
+    """
+
+    def __init__(self, path: Path, options: dict):
+        try:
+            from faster_whisper import WhisperModel as FasterWhisperModel
+        except ImportError as e:
+            raise EngineNotAvailable(
+                "faster-whisper is not installed, install the whisper extra"
+            ) from e
+        self.model = FasterWhisperModel(
+            str(path),
+            device="cpu",
+            compute_type=options.get("compute_type", "int8"),
+            cpu_threads=options.get("cpu_threads", 0),
+            num_workers=options.get("num_workers", 1),
+        )
+        self.language = options.get("language")
+        self.beam_size = options.get("beam_size", 5)
+
+    @classmethod
+    def available(cls) -> bool:
+        # the packaged server is built without the whisper extra
+        return importlib.util.find_spec("faster_whisper") is not None
+
+    def transcribe(self, pcm: bytes) -> list:
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768
+        segments, _ = self.model.transcribe(
+            samples,
+            language=self.language,
+            beam_size=self.beam_size,
+            word_timestamps=True,
+            # windows are transcribed independently, see WhisperRecognizer
+            condition_on_previous_text=False,
+        )
+        return list(segments)
+
+    def recognizer(self) -> Recognizer:
+        return WhisperRecognizer(self)
+
+
+ENGINES: Dict[str, Type[EngineModel]] = {
+    "vosk": VoskModel,
+    "faster-whisper": WhisperModel,
+}
+
+
+def engine_available(engine: str) -> bool:
+    return engine in ENGINES and ENGINES[engine].available()
+
+
+def load_model(engine: str, path: Path, options: dict) -> EngineModel:
+    if engine not in ENGINES:
+        raise EngineNotAvailable(f"Unknown engine {engine!r}")
+    return ENGINES[engine](path, options)
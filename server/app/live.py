@@ -0,0 +1,81 @@
+import time
+from typing import List, Optional
+
+from .audio import SAMPLE_RATE, SAMPLE_WIDTH
+from .engines import EngineModel
+from .transcribe import UtteranceParagraphs
+
+
+class LiveTranscription:
+    """
+    Transcribes a live stream of 16kHz mono int16 frames.
+
+    Every fed frame results in messages for the client: the words of a finished
+    utterance ("final") or the words recognized so far in the current utterance
+    ("partial"), both as a paragraph in the shape of `transform_vosk_result`.
+    Many live transcriptions can share one model, each has its own recognizer.
+    """
+
+    def __init__(self, model: EngineModel, name: str):
+        self.rec = model.recognizer()
+        self.finished: List[dict] = []
+        self.paragraphs = UtteranceParagraphs(self.finished.append, name, 0)
+        self.last_partial = None
+        self.frames = 0
+        self.duration = 0.0
+        self.latencies: List[float] = []
+
+    def feed(self, frame: bytes) -> List[dict]:
+        start = time.monotonic()
+        self.frames += 1
+        self.duration += len(frame) / (SAMPLE_RATE * SAMPLE_WIDTH)
+        words = self.rec.accept(frame)
+        if words is not None:
+            messages = self._final(words)
+        else:
+            messages = self._partial(*self.rec.partial())
+        latency = time.monotonic() - start
+        self.latencies.append(latency)
+        for message in messages:
+            message["latency"] = latency
+        return messages
+
+    def finish(self) -> List[dict]:
+        messages = self._final(self.rec.finish())
+        latencies = sorted(self.latencies) or [0.0]
+        messages.append(
+            {
+                "type": "done",
+                "frames": self.frames,
+                "duration": self.duration,
+                "latency": {
+                    "mean": sum(latencies) / len(latencies),
+                    "p95": latencies[int(0.95 * (len(latencies) - 1))],
+                    "max": latencies[-1],
+                },
+            }
+        )
+        return messages
+
+    def _final(self, words: List[dict]) -> List[dict]:
+        self.last_partial = None
+        self.paragraphs(words)
+        messages = [
+            {"type": "final", "paragraph": paragraph} for paragraph in self.finished
+        ]
+        self.finished.clear()
+        return messages
+
+    def _partial(self, text: str, words: Optional[List[dict]]) -> List[dict]:
+        if not text or text == self.last_partial:
+            return []
+        self.last_partial = text
+        return [
+            {
+                "type": "partial",
+                "text": text,
+                "paragraph": (
+                    self.paragraphs.paragraph(words) if words is not None else None
+                ),
+            }
+        ]
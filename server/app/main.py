@@ -1,6 +1,10 @@
 import base64
+import gzip
+import hashlib
 import json
 import os
+import threading
+from contextlib import ExitStack
 from typing import List, Optional
 
 from fastapi import (
@@ -10,25 +14,61 @@ from fastapi import (
     File,
     Form,
     HTTPException,
+    Query,
     Request,
     UploadFile,
+    WebSocket,
+    WebSocketDisconnect,
 )
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
-from starlette.status import HTTP_401_UNAUTHORIZED
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.status import (
+    HTTP_304_NOT_MODIFIED,
+    HTTP_401_UNAUTHORIZED,
+    HTTP_409_CONFLICT,
+    WS_1008_POLICY_VIOLATION,
+)
 
+from .audio import SAMPLE_WIDTH
+from .config import (
+    PRELOAD_MODELS,
+    RESULT_TTL,
+    TASK_STORE,
+    TASK_STORE_FLUSH_INTERVAL,
+    TASK_STORE_PATH,
+)
+from .live import LiveTranscription
+from .metrics import CONTENT_TYPE, metrics, peak_rss
 from .models import (
+    DownloadModelState,
     DownloadModelTask,
     LanguageDoesNotExist,
     ModelDoesNotExist,
     ModelNotDownloaded,
     ModelTypeNotSupported,
+    PreloadModelTask,
     models,
 )
+from .recognition import recognition
+from .result_cache import result_cache, result_key
+from .scheduler import QueueFull, scheduler
+from .task_store import SqliteTaskStore, serialize_task, summarize_task
+
 # Temporarily disabled due to build issues with OpenTimelineIO on Apple Silicon
 # from .otio import Segment, convert_otio
-from .tasks import TaskNotFoundError, tasks
-from .transcribe import TranscriptionState, TranscriptionTask, process_audio
+from .tasks import Task, TaskNotFoundError, tasks
+from .transcribe import (
+    TranscriptionState,
+    TranscriptionTask,
+    discard_upload,
+    recycle_process_pool,
+    rename_speakers,
+    resume_transcriptions,
+    shutdown_process_pool,
+    submit_transcription,
+    upload_path,
+)
 
 app = FastAPI()
 origins = ["*"]
@@ -41,6 +81,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+
 AUTH_TOKEN = base64.b64encode(os.urandom(64)).decode()
 
 
@@ -53,35 +95,98 @@ def token_auth(request: Request):
 
 @app.on_event("startup")
 def startup_event():
+    if TASK_STORE == "sqlite":
+        tasks.open(
+            SqliteTaskStore(TASK_STORE_PATH), TASK_STORE_FLUSH_INTERVAL, RESULT_TTL
+        )
+        resume_transcriptions()
+        for task in list(tasks.list()):
+            if isinstance(task, DownloadModelTask) and task.state not in (
+                DownloadModelState.DONE,
+                DownloadModelState.CANCELED,
+                DownloadModelState.FAILED,
+            ):
+                # the partial download is resumed where it stopped
+                threading.Thread(
+                    target=models.download,
+                    args=(task.model_id, task.uuid),
+                    daemon=True,
+                ).start()
+    # workers of the process pool keep their own copies of the models
+    models.loaded.evict_callbacks.append(recycle_process_pool)
+    models.loaded.evict_callbacks.append(recognition.evict)
+    threading.Thread(target=models.loaded.run_idle_eviction, daemon=True).start()
+    for model_id in PRELOAD_MODELS:
+        task = tasks.add(PreloadModelTask(model_id))
+        threading.Thread(
+            target=models.preload, args=(model_id, task.uuid), daemon=True
+        ).start()
     print(json.dumps({"msg": "server_started", "token": AUTH_TOKEN}), flush=True)
 
 
+@app.on_event("shutdown")
+def shutdown_event():
+    shutdown_process_pool()
+    tasks.close()
+
+
 @app.post("/tasks/start_transcription/")
 async def start_transcription(
-    background_tasks: BackgroundTasks,
     transcription_model: str,
     diarize_max_speakers: Optional[int] = None,
     diarize: bool = False,
+    priority: int = 0,
     file: UploadFile = File(...),
     fileName: str = Form(...),
     auth: str = Depends(token_auth),
 ):
-    task = tasks.add(
-        TranscriptionTask(
-            file.filename,
-            TranscriptionState.QUEUED,
-        )
+    task = TranscriptionTask(file.filename, TranscriptionState.QUEUED)
+    # keep the upload until the transcription is done, so it can be resumed
+    # if the server is restarted in between
+    source_hash = await run_in_threadpool(
+        save_upload, file.file, upload_path(task.uuid)
     )
-    background_tasks.add_task(
-        process_audio,
+    cache_key = result_key(
+        source_hash,
         transcription_model,
-        file.file,
-        fileName,
-        task.uuid,
         diarize,
-        diarize_max_speakers,
+        diarize_max_speakers if diarize else None,
     )
-    return task
+    cached = await run_in_threadpool(result_cache.get, cache_key)
+    if cached is not None:
+        discard_upload(task.uuid)
+        task.content = rename_speakers(cached["content"], cached["file_name"], fileName)
+        task.progress = 1
+        task.state = TranscriptionState.DONE
+        tasks.add(task)
+        return summarize_task(task)
+
+    job = {
+        "transcription_model": transcription_model,
+        "file_name": fileName,
+        "diarize": diarize,
+        "diarize_max_speakers": diarize_max_speakers,
+        "priority": priority,
+        "source_hash": source_hash,
+    }
+    tasks.add(task, job)
+    try:
+        submit_transcription(task, job)
+    except QueueFull:
+        tasks.delete(task.uuid)
+        discard_upload(task.uuid)
+        raise
+    return summarize_task(task)
+
+
+def save_upload(file, path) -> str:
+    """Save the uploaded `file` to `path` and return its sha256 hash"""
+    hash = hashlib.sha256()
+    with open(path, "wb") as target:
+        for block in iter(lambda: file.read(UPLOAD_BLOCK_SIZE), b""):
+            hash.update(block)
+            target.write(block)
+    return hash.hexdigest()
 
 
 @app.post("/tasks/download_model/")
@@ -95,20 +200,148 @@ async def download_model(
     return task
 
 
+@app.post("/tasks/preload_models/")
+async def preload_models(
+    background_tasks: BackgroundTasks,
+    model_id: List[str] = Query(...),
+    auth: str = Depends(token_auth),
+):
+    for preload_id in model_id:
+        # fail early for unknown or missing models
+        if not models.get_model_description(preload_id).is_downloaded():
+            raise ModelNotDownloaded()
+    preload_tasks = [tasks.add(PreloadModelTask(preload_id)) for preload_id in model_id]
+    for task in preload_tasks:
+        background_tasks.add_task(models.preload, task.model_id, task.uuid)
+    return preload_tasks
+
+
 # FIXME: this needs to be removed / put behind proper auth for security reasons
 @app.get("/tasks/list/")
 async def list_tasks(auth: str = Depends(token_auth)):
-    return sorted(tasks.list(), key=lambda x: x.uuid)
+    return [summarize_task(task) for task in sorted(tasks.list(), key=lambda x: x.uuid)]
+
+
+@app.get("/tasks/events/")
+async def task_events(
+    request: Request,
+    task_uuid: Optional[str] = None,
+    rate: float = Query(4, gt=0, le=100),
+    auth: str = Depends(token_auth),
+):
+    """
+    Server-sent events with the state of all tasks, or of the task `task_uuid`.
+
+    The current state of the tasks is sent first. After that, state transitions
+    are pushed immediately and progress updates at most `rate` times per second.
+    The `content` of tasks is never sent, it has to be fetched once they are done.
+    """
+    if task_uuid is not None:
+        tasks.get(task_uuid)
+    subscription = tasks.subscribe(task_uuid)
+
+    async def events():
+        try:
+            for task in list(tasks.list()):
+                if subscription.wants(task.uuid):
+                    yield task_event(task)
+            while not await request.is_disconnected():
+                await subscription.wait(1 / rate)
+                updated, deleted = subscription.take()
+                for task in updated:
+                    yield task_event(task)
+                for deleted_uuid in deleted:
+                    data = json.dumps({"uuid": deleted_uuid})
+                    yield f"event: delete\ndata: {data}\n\n"
+        finally:
+            tasks.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def task_event(task: Task) -> str:
+    return f"event: {type(task).__name__}\ndata: {serialize_task(task)}\n\n"
 
 
 @app.get("/tasks/{task_uuid}/")
 async def get_task(task_uuid: str, auth: str = Depends(token_auth)):
-    return tasks.get(task_uuid)
+    return summarize_task(tasks.get(task_uuid))
+
+
+@app.get("/tasks/{task_uuid}/result/")
+async def get_task_result(
+    task_uuid: str,
+    request: Request,
+    start: int = Query(0, ge=0),
+    count: Optional[int] = Query(None, ge=0),
+    auth: str = Depends(token_auth),
+):
+    """
+    The content of a finished task, e.g. the paragraphs of a transcription.
+
+    `start` and `count` select a range of paragraphs. The total number of
+    paragraphs is sent in the `X-Total-Count` header.
+    """
+    content = await run_in_threadpool(tasks.get_content, task_uuid)
+    if content is None:
+        raise HTTPException(status_code=HTTP_409_CONFLICT, detail="No result yet")
+    end = len(content) if count is None else min(start + count, len(content))
+    # results don't change once they are set, so they are identified by the task
+    etag = f'"{task_uuid}-{start}-{end}"'
+    headers = {
+        "ETag": etag,
+        "X-Total-Count": str(len(content)),
+        "Vary": "Accept-Encoding",
+    }
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+
+    gzipped = "gzip" in request.headers.get("Accept-Encoding", "")
+    body = await run_in_threadpool(encode_result, content[start:end], gzipped)
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@app.get("/tasks/{task_uuid}/partial/")
+async def get_task_partial_result(
+    task_uuid: str, cursor: int = Query(0, ge=0), auth: str = Depends(token_auth)
+):
+    """
+    The paragraphs a running transcription recognized so far, starting at `cursor`.
+
+    Pass the returned `cursor` to the next call to only get new paragraphs.
+    Paragraphs are returned in the order they were recognized, which isn't
+    necessarily their order in the audio. Once `done` is set, the complete
+    result has to be fetched from `/tasks/{task_uuid}/result/`, unless the
+    transcription failed and `error` is set.
+    """
+    task = tasks.get(task_uuid)
+    if not isinstance(task, TranscriptionTask):
+        raise HTTPException(status_code=HTTP_409_CONFLICT, detail="Not a transcription")
+    # the list is only appended to while the task runs and replaced when it is done
+    partial_content = task.partial_content
+    done = task.state in (TranscriptionState.DONE, TranscriptionState.FAILED)
+    return {
+        "paragraphs": partial_content[cursor:],
+        "cursor": max(len(partial_content), cursor),
+        "done": done,
+        "error": task.error,
+    }
+
+
+def encode_result(content, gzipped: bool) -> bytes:
+    body = json.dumps(content).encode()
+    if gzipped:
+        body = gzip.compress(body, compresslevel=6)
+    return body
 
 
 @app.delete("/tasks/{task_uuid}/")
 async def remove_task(task_uuid: str, auth: str = Depends(token_auth)):
-    return tasks.delete(task_uuid)
+    scheduler.discard(task_uuid)
+    tasks.delete(task_uuid)
+    discard_upload(task_uuid)
 
 
 @app.get("/models/available")
@@ -122,11 +355,93 @@ async def delete_model(model_id: str, auth: str = Depends(token_auth)):
     return PlainTextResponse("", status_code=200)
 
 
+@app.get("/models/loaded")
+async def get_loaded_models(auth: str = Depends(token_auth)):
+    return models.loaded.stats()
+
+
+@app.get("/models/load_stats")
+async def get_model_load_stats(auth: str = Depends(token_auth)):
+    return models.load_stats
+
+
+@app.get("/metrics")
+async def get_metrics(auth: str = Depends(token_auth)):
+    for model_id, stats in list(models.load_stats.items()):
+        metrics.set("audapolis_model_loads_total", stats.loads, model=model_id)
+        metrics.set(
+            "audapolis_model_load_seconds_total", stats.load_time, model=model_id
+        )
+    metrics.set("audapolis_loaded_models", len(models.loaded.stats()))
+    metrics.set("audapolis_queued_transcriptions", len(scheduler.queue))
+    metrics.set("audapolis_running_transcriptions", scheduler.running)
+    rss = peak_rss()
+    if rss is not None:
+        metrics.set("audapolis_peak_rss_bytes", rss)
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+
 @app.get("/models/downloaded")
 async def get_downloaded_models(auth: str = Depends(token_auth)):
     return models.downloaded
 
 
+@app.websocket("/live/transcribe/")
+async def live_transcription(
+    websocket: WebSocket, transcription_model: str, token: Optional[str] = None
+):
+    """
+    Transcribe a live stream of 16kHz mono int16 frames, sent as binary messages.
+
+    Results are sent back as json messages, see `LiveTranscription`. Send the
+    text message "end" to get the remaining results and close the connection.
+    Browsers can't set headers for websockets, so the auth token can also be
+    passed in the `token` query parameter.
+    """
+    authorization = websocket.headers.get("Authorization")
+    if authorization != f"Bearer {AUTH_TOKEN}" and token != AUTH_TOKEN:
+        await websocket.close(code=WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+
+    try:
+        with ExitStack() as stack:
+            try:
+                model = await run_in_threadpool(
+                    stack.enter_context, models.use(transcription_model)
+                )
+            except (ModelDoesNotExist, ModelNotDownloaded, ModelTypeNotSupported):
+                await websocket.send_json({"type": "error", "detail": "Invalid model"})
+                await websocket.close(code=WS_1008_POLICY_VIOLATION)
+                return
+
+            live = LiveTranscription(model, "live")
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                if message.get("bytes") is not None:
+                    frame = message["bytes"]
+                    if len(frame) % SAMPLE_WIDTH != 0:
+                        await websocket.send_json(
+                            {"type": "error", "detail": "Incomplete sample in frame"}
+                        )
+                        await websocket.close(code=WS_1008_POLICY_VIOLATION)
+                        return
+                    responses = await run_in_threadpool(live.feed, frame)
+                elif message.get("text") == "end":
+                    responses = await run_in_threadpool(live.finish)
+                else:
+                    continue
+                for response in responses:
+                    await websocket.send_json(response)
+                if message.get("text") == "end":
+                    await websocket.close()
+                    return
+    except WebSocketDisconnect:
+        pass
+
+
 # Temporarily disabled due to OpenTimelineIO build issues on Apple Silicon
 # @app.post("/util/otio/convert")
 # async def convert_otio_http(
@@ -144,6 +459,11 @@ async def task_not_found_error_handler(request, exc):
     return PlainTextResponse(str(exc), status_code=404)
 
 
+@app.exception_handler(QueueFull)
+async def queue_full_handler(request, exc):
+    return PlainTextResponse(str(exc), status_code=503)
+
+
 @app.exception_handler(LanguageDoesNotExist)
 async def language_does_not_exist_handler(request, exc):
     return PlainTextResponse(str(exc), status_code=404)
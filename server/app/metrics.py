@@ -0,0 +1,224 @@
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Tuple, TypeVar
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+T = TypeVar("T")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# name: (type, help) of every metric in the order they are rendered
+DESCRIPTIONS = {
+    "audapolis_transcriptions_total": (
+        "counter",
+        "Number of finished transcriptions",
+    ),
+    "audapolis_failed_transcriptions_total": (
+        "counter",
+        "Number of transcriptions that failed",
+    ),
+    "audapolis_transcribed_audio_seconds_total": (
+        "counter",
+        "Length of the audio of finished transcriptions",
+    ),
+    "audapolis_transcription_seconds_total": (
+        "counter",
+        "Wall time spent on finished transcriptions",
+    ),
+    "audapolis_skipped_silence_seconds_total": (
+        "counter",
+        "Length of non-speech that wasn't passed to the recognizer",
+    ),
+    "audapolis_phase_seconds_total": (
+        "counter",
+        "Wall time spent in each phase of transcriptions",
+    ),
+    "audapolis_phase_cpu_seconds_total": (
+        "counter",
+        "CPU time of the server process during each phase of transcriptions",
+    ),
+    "audapolis_decoded_bytes_total": (
+        "counter",
+        "Bytes of 16kHz mono int16 audio decoded from uploaded files",
+    ),
+    "audapolis_model_loads_total": (
+        "counter",
+        "Number of times each model was loaded",
+    ),
+    "audapolis_model_load_seconds_total": (
+        "counter",
+        "Time spent loading each model",
+    ),
+    "audapolis_loaded_models": (
+        "gauge",
+        "Number of models that are currently loaded",
+    ),
+    "audapolis_queued_transcriptions": (
+        "gauge",
+        "Number of transcriptions waiting for a worker",
+    ),
+    "audapolis_running_transcriptions": (
+        "gauge",
+        "Number of transcriptions that are currently running",
+    ),
+    "audapolis_peak_rss_bytes": (
+        "gauge",
+        "Peak resident memory of the server process",
+    ),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    """Aggregated metrics of the server, rendered in the prometheus text format"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values: Dict[str, Dict[Labels, float]] = defaultdict(dict)
+
+    def add(self, name: str, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self.values[name]
+            samples[key] = samples.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = value
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name, (metric_type, description) in DESCRIPTIONS.items():
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in sorted(self.values.get(name, {}).items()):
+                    if labels:
+                        label_text = ",".join(
+                            f'{key}="{escape_label(value)}"' for key, value in labels
+                        )
+                        lines.append(f"{name}{{{label_text}}} {value!r}")
+                    else:
+                        lines.append(f"{name} {value!r}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def peak_rss() -> Optional[int]:
+    """Peak resident memory of the server process in bytes, if it is known"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, linux kibibytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+metrics = Metrics()
+
+# The task that the phases measured in a thread are recorded on
+# and the stack of phases that are currently measured in it
+_local = threading.local()
+
+
+def current_task():
+    return getattr(_local, "task", None)
+
+
+@contextmanager
+def recording(task):
+    """
+    Record the phases measured in this thread on `task`. `task` needs the
+    `timings`, `cpu_times` and `decoded_bytes` attributes of a TranscriptionTask.
+    """
+    previous = current_task()
+    _local.task = task
+    try:
+        yield task
+    finally:
+        _local.task = previous
+
+
+class measure:
+    """
+    Add the wall and CPU time spent in the `with` block to `phase` of the task
+    that is recorded in this thread and to the aggregated metrics.
+
+    Time spent in nested phases only counts for the innermost phase, so the
+    phases of a task add up to its total time. The CPU time is that of the
+    whole server process, so work that runs at the same time (e.g. in other
+    threads) is included.
+    """
+
+    def __init__(self, phase: str):
+        self.phase = phase
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    def __enter__(self):
+        stack = _phase_stack()
+        if stack:
+            stack[-1]._pause()
+        stack.append(self)
+        self._resume()
+        return self
+
+    def __exit__(self, *exc):
+        self._pause()
+        stack = _phase_stack()
+        stack.pop()
+        if stack:
+            stack[-1]._resume()
+
+        task = current_task()
+        if task is not None:
+            task.timings[self.phase] = task.timings.get(self.phase, 0) + self.wall
+            task.cpu_times[self.phase] = task.cpu_times.get(self.phase, 0) + self.cpu
+        metrics.add("audapolis_phase_seconds_total", self.wall, phase=self.phase)
+        metrics.add("audapolis_phase_cpu_seconds_total", self.cpu, phase=self.phase)
+
+    def _resume(self):
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def _pause(self):
+        self.wall += time.perf_counter() - self.wall_start
+        self.cpu += time.process_time() - self.cpu_start
+
+
+def _phase_stack() -> list:
+    stack = getattr(_local, "phases", None)
+    if stack is None:
+        stack = _local.phases = []
+    return stack
+
+
+def measure_iter(phase: str, iterable: Iterable[T]) -> Iterator[T]:
+    """Yield the items of `iterable`, measuring the time spent producing them"""
+    iterator = iter(iterable)
+    while True:
+        with measure(phase):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def count_decoded_bytes(count: int):
+    task = current_task()
+    if task is not None:
+        task.decoded_bytes += count
+    metrics.add("audapolis_decoded_bytes_total", count)
@@ -1,20 +1,42 @@
 import enum
+import os
+import pickle
+import re
 import shutil
-import tempfile
-from collections import defaultdict
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import Any, Callable, Dict, Iterator, List, Optional
 from urllib.parse import urlparse
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo
 
-import requests
 import yaml
-from vosk import Model
 
-from .config import CACHE_DIR, DATA_DIR
+from .config import (
+    CACHE_DIR,
+    DATA_DIR,
+    DOWNLOAD_DIR,
+    MODEL_CACHE_SIZE,
+    MODEL_IDLE_TIMEOUT,
+)
+from .download import ChecksumMismatch, DownloadError, PartialDownload
+from .engines import EngineModel, EngineNotAvailable, engine_available, load_model
 from .tasks import Task, tasks
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader  # type: ignore
+
+EXTRACT_CHUNK_SIZE = 1024 * 1024
+# Bump this when ModelDescription or Language change to invalidate the cache
+MODELS_YML_CACHE_VERSION = 4
+MODELS_YML_CACHE = CACHE_DIR / "models.yml.pickle"
+
 
 class LanguageDoesNotExist(Exception):
     pass
@@ -42,16 +64,34 @@ class ModelDescription:
     lang: str
     compressed: bool = field(default=False)
     model_id: str = field(default=None)
+    # optional sha256 hex digest of the downloaded file
+    sha256: Optional[str] = field(default=None)
+    # the engine that runs the model, see `engines.ENGINES`, and its options
+    engine: str = field(default="vosk")
+    engine_options: Dict[str, Any] = field(default_factory=dict)
+    # urls of the files of models that aren't a single archive. They are
+    # downloaded into a directory, `url` only names the model then.
+    files: Optional[List[str]] = field(default=None)
 
     def __post_init__(self):
         self.model_id = f"{self.type}-{self.lang}-{self.name}"
+        # the entry in DATA_DIR that exists if the model is downloaded
+        self.file_name = Path(urlparse(self.url).path).name + ".model"
+        if self.files is not None:
+            # multilingual models are listed for several languages with the same
+            # url. The listings share the files in `path()`, so each downloaded
+            # listing is marked by a file of its own, see `Models.delete`.
+            language = re.sub(r"\W+", "-", self.lang).strip("-").lower()
+            self.file_name = (
+                f"{Path(urlparse(self.url).path).name}-{language}.downloaded"
+            )
 
     def path(self) -> Path:
-        url = urlparse(self.url)
-        return DATA_DIR / (Path(url.path).name + ".model")
+        """The files of the model"""
+        return DATA_DIR / (Path(urlparse(self.url).path).name + ".model")
 
     def is_downloaded(self) -> bool:
-        return self.path().exists()
+        return (DATA_DIR / self.file_name).exists()
 
 
 @dataclass
@@ -63,40 +103,220 @@ class Language:
         return self.transcription_models
 
 
+@dataclass
+class LoadStats:
+    # number of times the model was loaded and the total time that took
+    loads: int = 0
+    load_time: float = 0
+    # number of callers that had to wait for a load that was already in flight
+    # and the total time they waited
+    waits: int = 0
+    wait_time: float = 0
+
+
+@dataclass
+class LoadedModel:
+    model: EngineModel
+    size: int
+    load_time: float
+    last_used: float = field(default_factory=time.monotonic)
+    hits: int = 0
+    pins: int = 0
+
+
+class ModelCache:
+    """
+    LRU cache for loaded models.
+
+    Models are evicted when the total size of the cached models exceeds the
+    budget or when they haven't been used for `idle_timeout` seconds. Models
+    that are pinned (i.e. used by a running transcription) are never evicted.
+    """
+
+    def __init__(self, budget: int = MODEL_CACHE_SIZE, idle_timeout=MODEL_IDLE_TIMEOUT):
+        self.budget = budget
+        self.idle_timeout = idle_timeout
+        self.entries: "OrderedDict[str, LoadedModel]" = OrderedDict()
+        self.lock = threading.RLock()
+        # called with the id of every evicted model
+        self.evict_callbacks: List[Callable[[str], None]] = []
+
+    def __contains__(self, model_id: str) -> bool:
+        return model_id in self.entries
+
+    def get(self, model_id: str) -> LoadedModel:
+        with self.lock:
+            entry = self.entries[model_id]
+            self.entries.move_to_end(model_id)
+            entry.last_used = time.monotonic()
+            entry.hits += 1
+            return entry
+
+    def put(self, model_id: str, entry: LoadedModel):
+        with self.lock:
+            self.entries[model_id] = entry
+            self.entries.move_to_end(model_id)
+            self.evict()
+
+    def pin(self, model_id: str):
+        with self.lock:
+            self.entries[model_id].pins += 1
+
+    def unpin(self, model_id: str):
+        with self.lock:
+            entry = self.entries[model_id]
+            entry.pins -= 1
+            entry.last_used = time.monotonic()
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            # the newest model is kept even if it exceeds the budget on its own
+            for model_id in list(self.entries)[:-1]:
+                if self.size() <= self.budget:
+                    break
+                if self.entries[model_id].pins == 0:
+                    self._remove(model_id)
+
+    def evict_idle(self):
+        with self.lock:
+            now = time.monotonic()
+            for model_id, entry in list(self.entries.items()):
+                if entry.pins == 0 and now - entry.last_used > self.idle_timeout:
+                    self._remove(model_id)
+
+    def _remove(self, model_id: str):
+        del self.entries[model_id]
+        for callback in self.evict_callbacks:
+            callback(model_id)
+
+    def run_idle_eviction(self):
+        if self.idle_timeout <= 0:
+            return
+        while True:
+            time.sleep(max(self.idle_timeout / 10, 1))
+            self.evict_idle()
+
+    def size(self) -> int:
+        return sum(entry.size for entry in self.entries.values())
+
+    def stats(self) -> Dict[str, dict]:
+        with self.lock:
+            now = time.monotonic()
+            return {
+                model_id: {
+                    "size": entry.size,
+                    "load_time": entry.load_time,
+                    "idle_time": now - entry.last_used,
+                    "hits": entry.hits,
+                    "in_use": entry.pins > 0,
+                }
+                for model_id, entry in self.entries.items()
+            }
+
+
+def directory_size(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
 class ModelDefaultDict(defaultdict):
     def __missing__(self, key):
         self[key] = Language(lang=key)
         return self[key]
 
 
+def parse_models_yml(path: Path):
+    with open(path, "r") as f:
+        models_raw = yaml.load(f, Loader=YamlLoader)
+        languages = ModelDefaultDict()
+        models = {}
+        for lang, lang_models in list(models_raw.items()):
+            for model in lang_models:
+                model_description = ModelDescription(lang=lang, **model)
+                models[model_description.model_id] = model_description
+                if model["type"] == "transcription":
+                    languages[lang].transcription_models.append(model_description)
+    return dict(languages), models
+
+
+def load_models_yml(path: Path):
+    """Parse models.yml, using a pickled copy in the cache dir if it is up to date"""
+    stat = path.stat()
+    key = (MODELS_YML_CACHE_VERSION, stat.st_mtime_ns, stat.st_size)
+    try:
+        with open(MODELS_YML_CACHE, "rb") as f:
+            cached_key, parsed = pickle.load(f)
+        if cached_key == key:
+            return parsed
+    except Exception:
+        # missing, outdated or corrupted cache
+        pass
+
+    parsed = parse_models_yml(path)
+    try:
+        with open(MODELS_YML_CACHE, "wb") as f:
+            pickle.dump((key, parsed), f)
+    except OSError:
+        pass
+    return parsed
+
+
 class Models:
     def __init__(self):
-        with open(Path(__file__).parent / "models.yml", "r") as f:
-            models_raw = yaml.safe_load(f)
-            languages = ModelDefaultDict()
-            models = {}
-            for lang, lang_models in list(models_raw.items()):
-                for model in lang_models:
-                    model_description = ModelDescription(lang=lang, **model)
-                    models[model_description.model_id] = model_description
-                    if model["type"] == "transcription":
-                        languages[lang].transcription_models.append(model_description)
-        self.available = dict(languages)
-        self.model_descriptions = models
-
-        # TODO: does it make sense to cache the models in memory
-        #  if we have more than one? also maybe add some time based
-        #  heuristics if it is smart to still keep the model in ram
-        self.loaded = {}
+        available, model_descriptions = load_models_yml(
+            Path(__file__).parent / "models.yml"
+        )
+        # models of engines whose optional dependencies aren't installed can't
+        # be loaded, so they aren't offered at all
+        self.model_descriptions = {
+            model_id: model
+            for model_id, model in model_descriptions.items()
+            if engine_available(model.engine)
+        }
+        self.available = {}
+        for lang, language in available.items():
+            transcription_models = [
+                model
+                for model in language.transcription_models
+                if model.model_id in self.model_descriptions
+            ]
+            if transcription_models:
+                self.available[lang] = Language(lang, transcription_models)
+        # the listings of multilingual models that share files are downloaded
+        # and deleted one at a time, see `_files_lock`
+        self.files_locks: Dict[Path, threading.Lock] = defaultdict(threading.Lock)
+        self.files_locks_lock = threading.Lock()
+        # index of the downloaded models, rebuilt whenever a model is
+        # downloaded or deleted
+        self._downloaded: Dict[str, ModelDescription] = {}
+        self._refresh_downloaded()
+
+        self.loaded = ModelCache()
+        # loads that are in flight, concurrent callers wait for these
+        self.loading: Dict[str, Future] = {}
+        self.load_stats: Dict[str, LoadStats] = defaultdict(LoadStats)
 
     @property
     def downloaded(self) -> Dict[str, ModelDescription]:
-        filtered = {}
-        for lang_name, lang in list(self.available.items()):
-            for model in lang.all_models():
-                if model.is_downloaded():
-                    filtered[model.model_id] = model
-        return filtered
+        # DATA_DIR also holds the task store, which changes all the time, so the
+        # index isn't invalidated by changes of the directory
+        return dict(self._downloaded)
+
+    def _refresh_downloaded(self):
+        """Rebuild the index, called by everything that adds or removes a model"""
+        present = set(os.listdir(DATA_DIR))
+        self._downloaded = {
+            model.model_id: model
+            for lang in self.available.values()
+            for model in lang.all_models()
+            if model.file_name in present
+        }
 
     def get_model_description(self, model_id) -> ModelDescription:
         if model_id not in self.model_descriptions:
@@ -105,69 +325,252 @@ class Models:
         return self.model_descriptions[model_id]
 
     def _load_model(self, model):
-        if model.type == "transcription":
-            return Model(str(model.path()))
-        else:
+        if model.type != "transcription":
             raise ModelTypeNotSupported()
+        try:
+            return load_model(model.engine, model.path(), model.engine_options)
+        except EngineNotAvailable as e:
+            raise ModelTypeNotSupported(str(e)) from e
+
+    def get(self, model_id: str) -> EngineModel:
+        return self._get_entry(model_id).model
 
-    def get(self, model_id: str) -> Union[Model]:
+    def _get_entry(self, model_id: str) -> LoadedModel:
         model = self.get_model_description(model_id)
         if not model.is_downloaded():
             raise ModelNotDownloaded()
 
-        if model_id not in self.loaded:
-            self.loaded[model_id] = self._load_model(model)
-        return self.loaded[model_id]
+        with self.loaded.lock:
+            if model_id in self.loaded:
+                return self.loaded.get(model_id)
+            load = self.loading.get(model_id)
+            if load is None:
+                load = self.loading[model_id] = Future()
+                loading = True
+            else:
+                loading = False
+
+        stats = self.load_stats[model_id]
+        start = time.monotonic()
+        if not loading:
+            # somebody else is already loading the model, share their result
+            entry = load.result()
+            with self.loaded.lock:
+                stats.waits += 1
+                stats.wait_time += time.monotonic() - start
+            return entry
+
+        try:
+            loaded = self._load_model(model)
+            entry = LoadedModel(
+                model=loaded,
+                size=directory_size(model.path()),
+                load_time=time.monotonic() - start,
+            )
+            self.loaded.put(model_id, entry)
+            load.set_result(entry)
+            return entry
+        except BaseException as e:
+            load.set_exception(e)
+            raise
+        finally:
+            with self.loaded.lock:
+                del self.loading[model_id]
+                stats.loads += 1
+                stats.load_time += time.monotonic() - start
+
+    @contextmanager
+    def use(self, model_id: str) -> Iterator[EngineModel]:
+        """Get a model and keep it from being evicted until the context exits"""
+        while True:
+            entry = self._get_entry(model_id)
+            with self.loaded.lock:
+                # the model might have been evicted since we got it
+                if self.loaded.entries.get(model_id) is entry:
+                    self.loaded.pin(model_id)
+                    break
+        try:
+            yield entry.model
+        finally:
+            self.loaded.unpin(model_id)
+
+    def preload(self, model_id: str, task_uuid: str):
+        task: PreloadModelTask = tasks.get(task_uuid)
+        task.state = PreloadModelState.LOADING
+        try:
+            entry = self._get_entry(model_id)
+        except Exception:
+            task.state = PreloadModelState.FAILED
+            raise
+        task.load_time = entry.load_time
+
+        task.state = PreloadModelState.WARMING_UP
+        entry.model.warm_up()
+        task.state = PreloadModelState.DONE
 
     def download(self, model_id: str, task_uuid: str):
         task: DownloadModelTask = tasks.get(task_uuid)
+        try:
+            self._download(model_id, task)
+        except Exception as e:
+            # failed downloads aren't resumed after a restart, the partial
+            # download is kept for the next attempt unless it was rejected
+            task.error = str(e) or type(e).__name__
+            task.state = DownloadModelState.FAILED
+            raise
+
+    def _download(self, model_id: str, task: "DownloadModelTask"):
         model = self.get_model_description(model_id)
-        with tempfile.TemporaryFile(dir=CACHE_DIR) as f:
-            response = requests.get(model.url, stream=True)
-            task.total = int(response.headers.get("content-length"))
-            task.state = DownloadModelState.DOWNLOADING
+        if model.files is not None:
+            self._download_files(model, task)
+            return
+        download = PartialDownload(model.url, DOWNLOAD_DIR / f"{model.model_id}.part")
+
+        task.state = DownloadModelState.DOWNLOADING
+        download.fetch(task)
+        if task.canceled:
+            # the partial download is kept, so the next attempt can resume it
+            task.state = DownloadModelState.CANCELED
+            return
+        if not download.complete:
+            raise DownloadError(f"Download of {model.url} is incomplete")
+        if model.sha256 is not None and download.sha256() != model.sha256:
+            download.discard()
+            raise ChecksumMismatch(f"Checksum of {model.url} does not match")
+
+        task.state = DownloadModelState.EXTRACTING
+        self._extract(model, download.path, task)
+        if task.canceled:
+            task.state = DownloadModelState.CANCELED
+            return
+        download.discard()
 
-            for data in response.iter_content(
-                chunk_size=max(int(task.total / 1000), 1024 * 1024)
-            ):
-                task.add_progress(len(data))
+        task.state = DownloadModelState.DONE
+
+    def _files_lock(self, model: ModelDescription) -> threading.Lock:
+        with self.files_locks_lock:
+            return self.files_locks[model.path()]
 
-                f.write(data)
+    def _download_files(self, model: ModelDescription, task: "DownloadModelTask"):
+        with self._files_lock(model):
+            if not model.path().is_dir():
+                self._fetch_files(model, task)
                 if task.canceled:
                     return
-
-            task.state = DownloadModelState.EXTRACTING
-            if model.compressed:
-                with ZipFile(f) as archive:
-                    target_dir = model.path()
-                    for info in archive.infolist():
-                        if info.is_dir():
-                            continue
-                        path = target_dir / Path("/".join(info.filename.split("/")[1:]))
-                        path.parent.mkdir(exist_ok=True, parents=True)
-
-                        source = archive.open(info.filename)
-                        target = open(path, "wb")
-                        with source, target:
-                            shutil.copyfileobj(source, target)
-            else:
-                f.seek(0)
-                with open(model.path(), "wb") as target:
-                    shutil.copyfileobj(f, target)
-
+            # the files are complete, possibly downloaded for another language
+            (DATA_DIR / model.file_name).touch()
+            self._refresh_downloaded()
         task.state = DownloadModelState.DONE
 
+    def _fetch_files(self, model: ModelDescription, task: "DownloadModelTask"):
+        directory = DOWNLOAD_DIR / model.path().name
+        downloads = {
+            Path(urlparse(url).path).name: PartialDownload(
+                url, directory / f"{Path(urlparse(url).path).name}.part"
+            )
+            for url in model.files
+        }
+
+        task.state = DownloadModelState.DOWNLOADING
+        for download in downloads.values():
+            # the progress is that of the current file
+            download.fetch(task)
+            if task.canceled:
+                task.state = DownloadModelState.CANCELED
+                return
+            if not download.complete:
+                raise DownloadError(f"Download of {download.url} is incomplete")
+
+        # like `_extract`, the files are moved into place once all of them are there
+        task.state = DownloadModelState.EXTRACTING
+        target = model.path()
+        staging = target.with_name(target.name + ".staging")
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        for name, download in downloads.items():
+            shutil.move(download.path, staging / name)
+            download.discard()
+        if target.is_dir():
+            shutil.rmtree(target)
+        staging.replace(target)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def _extract(
+        self, model: ModelDescription, source: Path, task: "DownloadModelTask"
+    ):
+        # extract into a staging directory next to the target and move it into
+        # place once it is complete, so an interrupted extraction never leaves
+        # a half extracted model that looks downloaded
+        target = model.path()
+        staging = target.with_name(target.name + ".staging")
+        if staging.is_dir():
+            shutil.rmtree(staging)
+        elif staging.exists():
+            staging.unlink()
+
+        if model.compressed:
+            with ZipFile(source) as archive:
+                members = [info for info in archive.infolist() if not info.is_dir()]
+                task.total = sum(info.file_size for info in members)
+                task.processed = 0
+
+                def extract_member(info: ZipInfo):
+                    path = staging / Path("/".join(info.filename.split("/")[1:]))
+                    path.parent.mkdir(exist_ok=True, parents=True)
+                    with archive.open(info) as src, open(path, "wb") as dst:
+                        while not task.canceled:
+                            data = src.read(EXTRACT_CHUNK_SIZE)
+                            if not data:
+                                break
+                            dst.write(data)
+                            task.add_progress(len(data))
+
+                # zlib releases the GIL, so members are decompressed in parallel
+                with ThreadPoolExecutor() as executor:
+                    list(executor.map(extract_member, members))
+        else:
+            task.total = source.stat().st_size
+            task.processed = 0
+            with open(source, "rb") as src, open(staging, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            task.add_progress(task.total)
+
+        if task.canceled:
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        if target.is_dir():
+            shutil.rmtree(target)
+        staging.replace(target)
+        self._refresh_downloaded()
+
     def delete(self, model_id: str):
         model = self.get_model_description(model_id)
-        if model.is_downloaded():
+        if model.files is not None:
+            self._delete_files(model)
+        elif model.is_downloaded():
             path = model.path()
             if path.is_dir():
                 shutil.rmtree(path)
             else:
                 path.unlink()
+            self._refresh_downloaded()
         else:
             raise ModelNotDownloaded()
 
+    def _delete_files(self, model: ModelDescription):
+        with self._files_lock(model):
+            if not model.is_downloaded():
+                raise ModelNotDownloaded()
+            (DATA_DIR / model.file_name).unlink()
+            # the files are deleted with the last listing that uses them
+            if not any(
+                other.path() == model.path() and other.is_downloaded()
+                for other in self.model_descriptions.values()
+                if other.files is not None
+            ):
+                shutil.rmtree(model.path(), ignore_errors=True)
+            self._refresh_downloaded()
+
 
 models = Models()
 
@@ -178,6 +581,7 @@ class DownloadModelState(str, enum.Enum):
     EXTRACTING = "extracting"
     DONE = "done"
     CANCELED = "canceled"
+    FAILED = "failed"
 
 
 @dataclass
@@ -187,13 +591,36 @@ class DownloadModelTask(Task):
     total: float = 0
     processed: float = 0
     progress: float = 0
+    # why the download failed, if it did
+    error: Optional[str] = None
 
     def __post_init__(self):
         self.canceled = False
+        # progress is added by the threads of parallel downloads and extractions
+        self.progress_lock = threading.Lock()
 
     def add_progress(self, added):
-        self.processed += added
-        self.progress = self.processed / self.total
+        with self.progress_lock:
+            self.processed += added
+            self.progress = self.processed / self.total
+        self.notify_progress()
 
     def cancel(self):
         self.canceled = True
+
+
+class PreloadModelState(str, enum.Enum):
+    QUEUED = "queued"
+    LOADING = "loading"
+    WARMING_UP = "warming up"
+    DONE = "done"
+    FAILED = "failed"
+
+
+@dataclass
+class PreloadModelTask(Task):
+    persistent = False
+
+    model_id: str
+    state: PreloadModelState = PreloadModelState.QUEUED
+    load_time: float = 0
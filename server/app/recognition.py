@@ -0,0 +1,115 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+from .config import TRANSCRIPTION_WORKERS
+
+T = TypeVar("T")
+
+Call = Tuple[Future, Callable]
+
+
+class RecognitionPool:
+    """
+    A fixed number of worker threads that recognize audio for all transcriptions
+    that use the same model.
+
+    Every transcription submits its ranges as one job. The workers take ranges
+    from the waiting jobs in turn, so a long transcription doesn't hold back the
+    ones that started after it. However many transcriptions run, only `workers`
+    recognizers compete for the cores.
+    """
+
+    def __init__(self, workers: int):
+        self.condition = threading.Condition()
+        # the ranges of each job that still wait for a worker, in turn order
+        self.jobs: Deque[Deque[Call]] = deque()
+        self.closed = False
+        self.threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, calls: List[Callable[[], T]]) -> List["Future[T]"]:
+        job = deque((Future(), call) for call in calls)
+        futures = [future for future, _ in job]
+        if job:
+            with self.condition:
+                self.jobs.append(job)
+                self.condition.notify(len(job))
+        return futures
+
+    def shutdown(self):
+        """Let the workers exit once the ranges that were submitted are done"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _next(self) -> Optional[Call]:
+        with self.condition:
+            while not self.jobs:
+                if self.closed:
+                    return None
+                self.condition.wait()
+            job = self.jobs.popleft()
+            call = job.popleft()
+            if job:
+                self.jobs.append(job)
+            return call
+
+    def _work(self):
+        while True:
+            next_call = self._next()
+            if next_call is None:
+                return
+            future, call = next_call
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = call()
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+class RecognitionService:
+    """Runs recognition on a `RecognitionPool` per model"""
+
+    def __init__(self, workers: Optional[int] = TRANSCRIPTION_WORKERS):
+        # recognition is cpu bound, more workers than cores don't help
+        self.workers = workers or os.cpu_count() or 1
+        self.lock = threading.Lock()
+        self.pools: Dict[str, RecognitionPool] = {}
+
+    def pool(self, model_id: str) -> RecognitionPool:
+        with self.lock:
+            if model_id not in self.pools:
+                self.pools[model_id] = RecognitionPool(self.workers)
+            return self.pools[model_id]
+
+    def evict(self, model_id: str):
+        """
+        Drop the pool of `model_id`, called when the model is evicted from the
+        model cache. A new pool is started if the model is used again.
+        """
+        with self.lock:
+            pool = self.pools.pop(model_id, None)
+        if pool is not None:
+            pool.shutdown()
+
+    def map(self, model_id: str, calls: List[Callable[[], T]]) -> List[T]:
+        """Run `calls` on the workers of `model_id` and return their results"""
+        futures = self.pool(model_id).submit(calls)
+        try:
+            return [future.result() for future in futures]
+        finally:
+            # if one call failed, the others that didn't start yet are dropped
+            for future in futures:
+                future.cancel()
+
+
+recognition = RecognitionService()
@@ -0,0 +1,56 @@
+import gzip
+import hashlib
+import json
+from typing import BinaryIO, Optional
+
+from .config import (
+    DIARIZATION_MODE,
+    RESULT_CACHE_DIR,
+    RESULT_CACHE_SIZE,
+    TRANSCRIPTION_CHUNK_LENGTH,
+    VAD_GATING,
+)
+from .disk_cache import DiskCache
+
+# Bump this if the format of transcription results changes,
+# so results in the old format aren't returned anymore
+RESULT_CACHE_VERSION = 2
+
+
+def result_key(
+    source_hash: str, model_id: str, diarize: bool, max_speakers: Optional[int]
+) -> str:
+    """The cache key of the transcription of the audio with hash `source_hash`"""
+    parameters = [
+        RESULT_CACHE_VERSION,
+        source_hash,
+        model_id,
+        diarize,
+        max_speakers,
+        # these change the recognized words and their speakers as well, e.g.
+        # gating can drop quiet words and chunks are split at other positions
+        VAD_GATING,
+        DIARIZATION_MODE,
+        TRANSCRIPTION_CHUNK_LENGTH,
+    ]
+    return hashlib.sha256(json.dumps(parameters).encode()).hexdigest()
+
+
+class ResultCache(DiskCache):
+    """
+    Transcription results stored as gzipped json files, as a dict with the
+    "content" and the "file_name" that was used in the speakers of the content
+    """
+
+    suffix = ".json.gz"
+
+    def read(self, file: BinaryIO):
+        with gzip.open(file, "rt") as f:
+            return json.load(f)
+
+    def write(self, file: BinaryIO, value):
+        with gzip.open(file, "wt") as f:
+            json.dump(value, f)
+
+
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_SIZE)
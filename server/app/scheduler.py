@@ -0,0 +1,117 @@
+import heapq
+import itertools
+import threading
+import traceback
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+from .config import SCHEDULER_MAX_QUEUE, SCHEDULER_MIN_FREE_MEMORY, SCHEDULER_WORKERS
+from .tasks import Task
+
+
+class QueueFull(Exception):
+    pass
+
+
+@dataclass(order=True)
+class Job:
+    sort_key: tuple
+    task: Task = field(compare=False)
+    fn: Callable = field(compare=False)
+    args: tuple = field(compare=False)
+
+
+def available_memory() -> Optional[int]:
+    """Return the available memory in bytes or None if it can't be determined"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class Scheduler:
+    """
+    Runs jobs on a fixed number of worker threads.
+
+    Jobs with a higher priority run first, jobs with the same priority in the
+    order they were submitted. While a job waits, the `queue_position` of its
+    task is kept up to date. New jobs are rejected with `QueueFull` if too many
+    are waiting, and jobs are held back while the system is low on memory.
+    """
+
+    def __init__(
+        self,
+        workers: int = SCHEDULER_WORKERS,
+        max_queue: int = SCHEDULER_MAX_QUEUE,
+        min_free_memory: int = SCHEDULER_MIN_FREE_MEMORY,
+    ):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.min_free_memory = min_free_memory
+        self.queue: List[Job] = []
+        self.running = 0
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.threads: List[threading.Thread] = []
+
+    def submit(self, task: Task, fn: Callable, *args, priority: int = 0):
+        with self.condition:
+            if len(self.queue) >= self.max_queue:
+                raise QueueFull(f"{len(self.queue)} jobs are already waiting")
+            heapq.heappush(
+                self.queue, Job((-priority, next(self.counter)), task, fn, args)
+            )
+            self._update_positions()
+            self._start_workers()
+            self.condition.notify()
+
+    def discard(self, task_uuid: str):
+        with self.condition:
+            self.queue = [job for job in self.queue if job.task.uuid != task_uuid]
+            heapq.heapify(self.queue)
+            self._update_positions()
+
+    def _start_workers(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _update_positions(self):
+        for position, job in enumerate(sorted(self.queue)):
+            job.task.queue_position = position
+
+    def _may_start(self) -> bool:
+        if not self.queue:
+            return False
+        if self.running == 0:
+            # always make progress, even if memory is low
+            return True
+        free = available_memory()
+        return free is None or free >= self.min_free_memory
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self._may_start():
+                    # memory doesn't notify us when it is freed, so poll while waiting
+                    self.condition.wait(timeout=1 if self.queue else None)
+                job = heapq.heappop(self.queue)
+                job.task.queue_position = None
+                self._update_positions()
+                self.running += 1
+            try:
+                job.fn(*job.args)
+            except:  # noqa: E722
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    self.condition.notify()
+
+
+scheduler = Scheduler()
@@ -0,0 +1,128 @@
+import enum
+import json
+import sqlite3
+import threading
+import zlib
+from dataclasses import fields
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Type
+
+# Fields with this name are stored separately and only loaded when needed
+LAZY_FIELD = "content"
+
+
+def summarize_task(task) -> dict:
+    """
+    All fields of a task except its (possibly large) content and transient
+    fields, i.e. fields with `metadata={"transient": True}`
+    """
+    return {
+        f.name: getattr(task, f.name)
+        for f in fields(task)
+        if f.name != LAZY_FIELD and not f.metadata.get("transient", False)
+    }
+
+
+def serialize_task(task) -> str:
+    return json.dumps(
+        summarize_task(task),
+        default=lambda x: x.value if isinstance(x, enum.Enum) else str(x),
+    )
+
+
+def deserialize_task(cls: Type, serialized: str):
+    data = json.loads(serialized)
+    init_values = {}
+    for f in fields(cls):
+        if f.name not in data:
+            continue
+        value = data[f.name]
+        if isinstance(f.type, type) and issubclass(f.type, enum.Enum):
+            value = f.type(value)
+        if f.init:
+            init_values[f.name] = value
+    task = cls(**init_values)
+    task.uuid = data["uuid"]
+    return task
+
+
+class TaskStore:
+    """Interface for persisting tasks. This base class doesn't persist anything."""
+
+    persistent = False
+
+    def load(self) -> List[Tuple[str, str, Optional[dict], bool]]:
+        """Return (type, serialized task, job, has content) for all stored tasks"""
+        return []
+
+    def load_content(self, uuid: str):
+        return None
+
+    def write(
+        self,
+        updated: Iterable[Tuple[str, str, str, Optional[dict]]],
+        contents: Dict[str, object],
+        deleted: Iterable[str],
+    ):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteTaskStore(TaskStore):
+    persistent = True
+
+    def __init__(self, path: Path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "uuid TEXT PRIMARY KEY, type TEXT, data TEXT, job TEXT, content BLOB"
+                ")"
+            )
+
+    def load(self):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT type, data, job, content IS NOT NULL FROM tasks"
+            ).fetchall()
+        return [
+            (type, data, json.loads(job) if job else None, bool(has_content))
+            for type, data, job, has_content in rows
+        ]
+
+    def load_content(self, uuid: str):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT content FROM tasks WHERE uuid = ?", (uuid,)
+            ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def write(self, updated, contents, deleted):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO tasks (uuid, type, data, job) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(uuid) DO UPDATE SET data = excluded.data",
+                [
+                    (uuid, type, data, json.dumps(job) if job is not None else None)
+                    for uuid, type, data, job in updated
+                ],
+            )
+            self.connection.executemany(
+                "UPDATE tasks SET content = ? WHERE uuid = ?",
+                [
+                    (zlib.compress(json.dumps(content).encode()), uuid)
+                    for uuid, content in contents.items()
+                ],
+            )
+            self.connection.executemany(
+                "DELETE FROM tasks WHERE uuid = ?", [(uuid,) for uuid in deleted]
+            )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -1,22 +1,142 @@
-# This holds the tasks state. TODO(@pajowu), check if we should store this on disk
+# This holds the tasks state. Tasks are persisted by a TaskStore once `open` is called
+import asyncio
+import threading
+import time
+import traceback
 import uuid
 from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple, Type
+
+from .task_store import LAZY_FIELD, TaskStore, deserialize_task, serialize_task
+
+TASK_TYPES: Dict[str, Type["Task"]] = {}
 
 
 @dataclass
 class Task:
     uuid: str = field(default_factory=lambda: str(uuid.uuid4()), init=False)
 
+    # tasks of classes that set this to False are not written to the task store
+    persistent = True
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        TASK_TYPES[cls.__name__] = cls
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name == "state":
+            # state transitions are pushed to subscribers right away
+            tasks.publish(self, immediate=True)
+
+    def notify_progress(self):
+        """Called after the progress changed, pushed to subscribers throttled"""
+        tasks.publish(self)
+
     def cancel(self):
         pass
 
 
+class TaskSubscription:
+    """
+    Collects updates of tasks for one subscriber. Updates of the same task are
+    coalesced, so only the latest state of each task is sent.
+    """
+
+    def __init__(self, task_uuid: Optional[str] = None):
+        self.task_uuid = task_uuid
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        self.lock = threading.Lock()
+        self.updated: Dict[str, Task] = {}
+        self.deleted: Set[str] = set()
+
+    def wants(self, task_uuid: str) -> bool:
+        return self.task_uuid is None or self.task_uuid == task_uuid
+
+    def update(self, task: Task, immediate: bool):
+        with self.lock:
+            self.updated[task.uuid] = task
+        if immediate:
+            self.loop.call_soon_threadsafe(self.wake.set)
+
+    def delete(self, task_uuid: str):
+        with self.lock:
+            self.updated.pop(task_uuid, None)
+            self.deleted.add(task_uuid)
+        self.loop.call_soon_threadsafe(self.wake.set)
+
+    async def wait(self, interval: float):
+        """Wait for an immediate update, but at most `interval` seconds"""
+        try:
+            await asyncio.wait_for(self.wake.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        self.wake.clear()
+
+    def take(self) -> Tuple[List[Task], Set[str]]:
+        with self.lock:
+            updated, self.updated = list(self.updated.values()), {}
+            deleted, self.deleted = self.deleted, set()
+        return updated, deleted
+
+
 class Tasks:
     def __init__(self):
         self.tasks = {}
+        # what is needed to resume a task, e.g. the arguments of a transcription
+        self.jobs: Dict[str, dict] = {}
+        self.store = TaskStore()
+        self.lock = threading.Lock()
+        # state as last written to the store
+        self.written: Dict[str, str] = {}
+        self.written_content: Set[str] = set()
+        self.stored_content: Set[str] = set()
+        self.deleted: Set[str] = set()
+        # when the content of a task was last used, for evicting it after a while
+        self.content_used: Dict[str, float] = {}
+        self.flush_thread: Optional[threading.Thread] = None
+        self.closed = threading.Event()
+        self.subscriptions: List[TaskSubscription] = []
+
+    def open(self, store: TaskStore, flush_interval: float, content_ttl: float = 0):
+        """
+        Restore the tasks from `store` and periodically write changes to it.
+        Contents that weren't used for `content_ttl` seconds are dropped from
+        memory, they are loaded from the store again when needed.
+        """
+        self.store = store
+        for type, serialized, job, has_content in store.load():
+            if type not in TASK_TYPES:
+                continue
+            task = deserialize_task(TASK_TYPES[type], serialized)
+            self.tasks[task.uuid] = task
+            self.written[task.uuid] = serialized
+            if job is not None:
+                self.jobs[task.uuid] = job
+            if has_content:
+                self.stored_content.add(task.uuid)
+                self.written_content.add(task.uuid)
 
-    def add(self, task: Task):
+        self.flush_thread = threading.Thread(
+            target=self._flush_periodically,
+            args=(flush_interval, content_ttl),
+            daemon=True,
+        )
+        self.flush_thread.start()
+
+    def close(self):
+        self.closed.set()
+        if self.flush_thread is not None:
+            self.flush_thread.join()
+        self.flush()
+        self.store.close()
+
+    def add(self, task: Task, job: Optional[dict] = None):
         self.tasks[task.uuid] = task
+        if job is not None:
+            self.jobs[task.uuid] = job
+        self.publish(task, immediate=True)
         return task
 
     def get(self, uuid: str):
@@ -25,6 +145,16 @@ class Tasks:
         except KeyError:
             raise TaskNotFoundError()
 
+    def get_content(self, uuid: str):
+        """Return the content of a task, loading it from the store if it was evicted"""
+        task = self.get(uuid)
+        content = getattr(task, LAZY_FIELD, None)
+        if content is None and uuid in self.stored_content:
+            content = self.store.load_content(uuid)
+            setattr(task, LAZY_FIELD, content)
+        self.content_used[uuid] = time.monotonic()
+        return content
+
     def list(self):
         return self.tasks.values()
 
@@ -33,8 +163,84 @@ class Tasks:
             task = self.tasks[uuid]
             task.cancel()
             self.tasks.pop(uuid)
+            self.jobs.pop(uuid, None)
+            self.content_used.pop(uuid, None)
+            with self.lock:
+                self.deleted.add(uuid)
         except KeyError:
             raise TaskNotFoundError()
+        for subscription in self.subscriptions:
+            if subscription.wants(uuid):
+                subscription.delete(uuid)
+
+    def subscribe(self, task_uuid: Optional[str] = None) -> TaskSubscription:
+        """Subscribe to updates of all tasks or of a single one"""
+        subscription = TaskSubscription(task_uuid)
+        self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription: TaskSubscription):
+        self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+
+    def publish(self, task: Task, immediate: bool = False):
+        if task.uuid not in self.tasks:
+            # not added yet, `add` publishes it
+            return
+        # the list is replaced instead of modified, so it can be iterated
+        # from other threads without locking
+        for subscription in self.subscriptions:
+            if subscription.wants(task.uuid):
+                subscription.update(task, immediate)
+
+    def flush(self):
+        """Write all tasks that changed since the last flush to the store"""
+        with self.lock:
+            updated = []
+            contents = {}
+            for task_uuid, task in list(self.tasks.items()):
+                if not task.persistent:
+                    continue
+                serialized = serialize_task(task)
+                if self.written.get(task_uuid) != serialized:
+                    job = self.jobs.get(task_uuid)
+                    updated.append((task_uuid, type(task).__name__, serialized, job))
+                    self.written[task_uuid] = serialized
+                content = getattr(task, LAZY_FIELD, None)
+                if content is not None and task_uuid not in self.written_content:
+                    contents[task_uuid] = content
+                    self.written_content.add(task_uuid)
+                    self.stored_content.add(task_uuid)
+                    self.content_used.setdefault(task_uuid, time.monotonic())
+            deleted = self.deleted
+            self.deleted = set()
+            for task_uuid in deleted:
+                self.written.pop(task_uuid, None)
+                self.written_content.discard(task_uuid)
+                self.stored_content.discard(task_uuid)
+            if updated or contents or deleted:
+                self.store.write(updated, contents, deleted)
+
+    def evict_contents(self, ttl: float):
+        """Drop contents that are in the store and weren't used for `ttl` seconds"""
+        if not self.store.persistent:
+            return
+        now = time.monotonic()
+        for task_uuid, used in list(self.content_used.items()):
+            if now - used < ttl or task_uuid not in self.stored_content:
+                continue
+            task = self.tasks.get(task_uuid)
+            if task is not None:
+                setattr(task, LAZY_FIELD, None)
+            self.content_used.pop(task_uuid, None)
+
+    def _flush_periodically(self, interval: float, content_ttl: float):
+        while not self.closed.wait(interval):
+            try:
+                self.flush()
+                if content_ttl > 0:
+                    self.evict_contents(content_ttl)
+            except Exception:
+                traceback.print_exc()
 
 
 class TaskNotFoundError(Exception):
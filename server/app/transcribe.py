@@ -1,22 +1,50 @@
+import bisect
 import enum
-import json
+import functools
+import math
+import re
+import threading
+import time
 import traceback
-import warnings
-from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass
-from typing import Optional
+import wave
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 
-import numpy as np
 from fastapi import UploadFile
-from pydiar.models import BinaryKeyDiarizationModel, Segment
+from pydiar.models import Segment
 from pydiar.util.misc import optimize_segments
-from pydub import AudioSegment
-from vosk import KaldiRecognizer, Model
 
+from .audio import (
+    PCM_CACHE_VERSION,
+    SAMPLE_RATE,
+    SAMPLE_WIDTH,
+    PcmBuffer,
+    WavStream,
+    decode_file,
+    find_pause,
+    pcm_cache,
+    speech_ranges,
+)
+from .config import (
+    DIARIZATION_MODE,
+    TRANSCRIPTION_CHUNK_LENGTH,
+    TRANSCRIPTION_EXECUTOR,
+    TRANSCRIPTION_WORKERS,
+    UPLOAD_DIR,
+    VAD_GATING,
+)
+from .diarize import get_diarizer
+from .engines import EngineModel, load_model
+from .metrics import measure, measure_iter, metrics, peak_rss, recording
 from .models import models
+from .recognition import recognition
+from .result_cache import result_cache, result_key
+from .scheduler import scheduler
 from .tasks import Task, tasks
 
-SAMPLE_RATE = 16000
 # Number of seconds that should be fed into vosk.
 # Smaller = better progress estimates, but also slightly higher python overhead
 VOSK_BLOCK_SIZE = 2
@@ -29,6 +57,7 @@ class TranscriptionState(str, enum.Enum):
     DIARIZING = "diarizing"
     TRANSCRIBING = "transcribing"
     DONE = "done"
+    FAILED = "failed"
 
 
 @dataclass
@@ -39,58 +68,322 @@ class TranscriptionTask(Task):
     processed: float = 0
     content: Optional[dict] = None
     progress: float = 0
+    queue_position: Optional[int] = None
+    # why the transcription failed, if it did
+    error: Optional[str] = None
+    # wall and cpu seconds spent in each phase of the transcription, see `measure`
+    timings: Dict[str, float] = field(default_factory=dict)
+    cpu_times: Dict[str, float] = field(default_factory=dict)
+    audio_duration: float = 0
+    decoded_bytes: int = 0
+    # seconds of non-speech that weren't passed to the recognizer, see VAD_GATING
+    skipped_silence: float = 0
+    # seconds spent on the transcription per second of audio
+    realtime_factor: Optional[float] = None
+    # peak resident memory of the server process when the transcription was done
+    peak_rss: Optional[int] = None
+    # paragraphs of utterances that are already recognized, in the order they
+    # were recognized. Dropped once the transcription is done.
+    partial_content: List[dict] = field(
+        default_factory=list, metadata={"transient": True}
+    )
+
+    def __post_init__(self):
+        # progress is added by the threads that recognize chunks and segments
+        self.progress_lock = threading.Lock()
 
     def set_transcription_progress(self, processed):
-        self.processed += processed
-        self.progress = self.processed / self.total
-
-
-def transcribe_raw_data(model: Model, name, audio, offset, duration, process_callback):
-    rec = KaldiRecognizer(model, SAMPLE_RATE)
-    rec.SetWords(True)
-
-    finished = False
-    processed = offset
-    while not finished:
-        block_start = processed
-        block_end = processed + VOSK_BLOCK_SIZE
-        if block_end > offset + duration:
-            block_end = offset + duration
-            finished = True
-        data = audio[block_start * 1000 : block_end * 1000]
-        rec.AcceptWaveform(data.get_array_of_samples().tobytes())
-        processed = block_end
-        process_callback(processed - block_start)
-
-    vosk_result = json.loads(rec.FinalResult())
+        with self.progress_lock:
+            self.processed += processed
+            self.progress = self.processed / self.total
+        self.notify_progress()
+
+    def add_partial_content(self, paragraph: dict):
+        self.partial_content.append(paragraph)
+        self.notify_progress()
+
+
+WordsCallback = Callable[[List[dict]], None]
+
+
+def recognize_blocks(
+    model: EngineModel,
+    blocks: Iterable[bytes],
+    process_callback,
+    words_callback: Optional[WordsCallback] = None,
+) -> dict:
+    rec = model.recognizer()
+
+    words = []
+    for block in blocks:
+        utterance = rec.accept(block)
+        if utterance is not None:
+            # an utterance ended, its words won't change anymore
+            words.extend(utterance)
+            if words_callback is not None:
+                words_callback(utterance)
+        process_callback(len(block) / (SAMPLE_RATE * SAMPLE_WIDTH))
+
+    utterance = rec.finish()
+    words.extend(utterance)
+    if words_callback is not None:
+        words_callback(utterance)
+    return {"result": words}
+
+
+class UtteranceParagraphs:
+    """
+    Turns the words of each utterance recognized in the range at `offset` into
+    one paragraph and passes it to `add_paragraph`. Only words whose center
+    lies between `start` and `end` are kept.
+
+    Each paragraph starts where the previous one of the range ended, including
+    the silence before its first word. Paragraphs of different ranges don't
+    overlap, so clients can sort them by the start of their first item.
+    """
+
+    def __init__(
+        self,
+        add_paragraph: Callable[[dict], None],
+        name: str,
+        offset: float,
+        start: float = 0,
+        end: float = math.inf,
+    ):
+        self.add_paragraph = add_paragraph
+        self.name = name
+        self.offset = offset
+        self.start = start
+        self.end = end
+        self.position = max(start, offset)
+
+    def paragraph(self, words: List[dict]) -> Optional[dict]:
+        """Build the paragraph of an utterance without ending it"""
+        words = [
+            {
+                **word,
+                "start": word["start"] + self.offset,
+                "end": word["end"] + self.offset,
+            }
+            for word in words
+        ]
+        words = [
+            word
+            for word in words
+            if self.start <= (word["start"] + word["end"]) / 2 < self.end
+        ]
+        if not words:
+            return None
+        position = min(self.position, words[0]["start"])
+        relative = [
+            {**word, "start": word["start"] - position, "end": word["end"] - position}
+            for word in words
+        ]
+        return transform_vosk_result(
+            self.name, {"result": relative}, words[-1]["end"] - position, position
+        )
+
+    def __call__(self, words: List[dict]):
+        paragraph = self.paragraph(words)
+        if paragraph is None:
+            return
+        self.add_paragraph(paragraph)
+        last = paragraph["content"][-1]
+        self.position = last["sourceStart"] + last["length"]
+
+
+def recognize_range(
+    model: EngineModel,
+    pcm: PcmBuffer,
+    offset: float,
+    duration: float,
+    process_callback,
+    words_callback: Optional[WordsCallback] = None,
+) -> dict:
+    """
+    Recognize the words between `offset` and `offset + duration`, with times
+    relative to `offset`.
+
+    With VAD_GATING, only the speech in the range is passed to the recognizer,
+    a fresh one per stretch of speech. The skipped seconds count as processed
+    and are returned as "skipped". No words are returned for them, so they
+    become silence in `transform_vosk_result`.
+    """
+    if VAD_GATING == "off":
+        return recognize_blocks(
+            model,
+            pcm.blocks(offset, duration, VOSK_BLOCK_SIZE),
+            process_callback,
+            words_callback,
+        )
+
+    with measure("vad"):
+        ranges = speech_ranges(pcm, offset, offset + duration)
+    words = []
+    position = offset
+    for start, end in ranges:
+        process_callback(start - position)
+        shift = functools.partial(_shift_words, start - offset)
+        result = recognize_blocks(
+            model,
+            pcm.blocks(start, end - start, VOSK_BLOCK_SIZE),
+            process_callback,
+            None
+            if words_callback is None
+            else lambda words: words_callback(shift(words)),
+        )
+        words.extend(shift(result["result"]))
+        position = end
+    process_callback(offset + duration - position)
+    skipped = duration - sum(end - start for start, end in ranges)
+    return {"result": words, "skipped": skipped}
+
+
+def _shift_words(seconds: float, words: List[dict]) -> List[dict]:
+    return [
+        {**word, "start": word["start"] + seconds, "end": word["end"] + seconds}
+        for word in words
+    ]
+
+
+def transcribe_raw_data(
+    model: EngineModel,
+    name,
+    pcm: PcmBuffer,
+    offset,
+    duration,
+    process_callback,
+    words_callback: Optional[WordsCallback] = None,
+):
+    vosk_result = recognize_range(
+        model, pcm, offset, duration, process_callback, words_callback
+    )
     return transform_vosk_result(name, vosk_result, duration, offset)
 
 
 EPSILON = 0.00001
+# Seconds of audio that are decoded twice around chunk boundaries that
+# aren't in a pause
+CHUNK_OVERLAP = 2
+# Seconds around the target chunk boundary that are searched for a pause
+CHUNK_PAUSE_SEARCH_WINDOW = 10
+
+
+def use_chunks(duration: float) -> bool:
+    """Whether a non-diarized transcription should be split into parallel chunks"""
+    return (
+        TRANSCRIPTION_CHUNK_LENGTH > 0 and duration > 1.5 * TRANSCRIPTION_CHUNK_LENGTH
+    )
+
+
+def upload_path(task_uuid: str) -> Path:
+    """Where the uploaded file of a transcription is kept until it is done"""
+    return UPLOAD_DIR / task_uuid
+
+
+def discard_upload(task_uuid: str):
+    try:
+        upload_path(task_uuid).unlink(missing_ok=True)
+    except OSError:
+        # on windows files that are still open can't be deleted
+        traceback.print_exc()
+
+
+def submit_transcription(task: TranscriptionTask, job: dict):
+    """Queue the transcription described by `job`, see `start_transcription`"""
+    scheduler.submit(
+        task,
+        process_audio,
+        job["transcription_model"],
+        upload_path(task.uuid),
+        job["file_name"],
+        task.uuid,
+        job["diarize"],
+        job["diarize_max_speakers"],
+        job.get("source_hash"),
+        priority=job["priority"],
+    )
+
+
+def resume_transcriptions():
+    """Queue transcriptions that were interrupted by a restart of the server again"""
+    for task in list(tasks.list()):
+        if not isinstance(task, TranscriptionTask):
+            continue
+        if task.state in (TranscriptionState.DONE, TranscriptionState.FAILED):
+            continue
+        job = tasks.jobs.get(task.uuid)
+        if job is None or not upload_path(task.uuid).exists():
+            print(f"Can't resume transcription {task.uuid}, dropping it", flush=True)
+            tasks.delete(task.uuid)
+            continue
+        task.state = TranscriptionState.QUEUED
+        task.processed = 0
+        task.progress = 0
+        task.timings = {}
+        task.cpu_times = {}
+        task.decoded_bytes = 0
+        task.skipped_silence = 0
+        submit_transcription(task, job)
 
 
 def process_audio(
     transcription_model: str,
-    file: UploadFile,
+    file_path: Path,
     fileName: str,
     task_uuid: str,
     diarize: bool,
     diarize_max_speakers: Optional[int],
+    source_hash: Optional[str] = None,
 ):
     task = tasks.get(task_uuid)
 
-    content = transcribe(
-        task,
-        transcription_model,
-        file,
-        fileName,
-        task_uuid,
-        diarize,
-        diarize_max_speakers,
-    )
+    start = time.perf_counter()
+    try:
+        with open(file_path, "rb") as file, recording(task):
+            content = transcribe(
+                task,
+                transcription_model,
+                file,
+                fileName,
+                task_uuid,
+                diarize,
+                diarize_max_speakers,
+                source_hash,
+            )
+    except Exception as e:
+        # the upload is dropped as well, so the job isn't retried after a restart
+        task.error = str(e) or type(e).__name__
+        task.state = TranscriptionState.FAILED
+        task.partial_content = []
+        metrics.add("audapolis_failed_transcriptions_total", 1)
+        discard_upload(task_uuid)
+        raise
+    elapsed = time.perf_counter() - start
 
+    if task.audio_duration > 0:
+        task.realtime_factor = elapsed / task.audio_duration
+    task.peak_rss = peak_rss()
+    metrics.add("audapolis_transcriptions_total", 1)
+    metrics.add("audapolis_transcribed_audio_seconds_total", task.audio_duration)
+    metrics.add("audapolis_transcription_seconds_total", elapsed)
     task.content = content
     task.state = TranscriptionState.DONE
+    task.partial_content = []
+    if source_hash is not None:
+        cache_key = result_key(
+            source_hash,
+            transcription_model,
+            diarize,
+            diarize_max_speakers if diarize else None,
+        )
+        try:
+            # the same audio may be uploaded under another name later,
+            # see `rename_speakers`
+            result_cache.put(cache_key, {"file_name": fileName, "content": content})
+        except OSError:
+            traceback.print_exc()
+    discard_upload(task_uuid)
 
 
 def transcribe(
@@ -101,75 +394,542 @@ def transcribe(
     task_uuid: str,
     diarize: bool,
     diarize_max_speakers: Optional[int],
+    source_hash: Optional[str] = None,
 ):
     task.state = TranscriptionState.LOADING_TRANSCRIPTION_MODEL
 
     # TODO: Set error state if model does not exist
-    model = models.get(transcription_model)
+    with ExitStack() as stack:
+        with measure("model_loading"):
+            model = stack.enter_context(models.use(transcription_model))
+        return transcribe_file(
+            task,
+            model,
+            transcription_model,
+            file,
+            fileName,
+            diarize,
+            diarize_max_speakers,
+            source_hash,
+        )
 
-    with warnings.catch_warnings():
-        # we ignore the warning that ffmpeg is not found as we
-        # don't need ffmpeg to decode wav files
-        warnings.filterwarnings("ignore", ".*ffmpeg.*")
-        audio = AudioSegment.from_wav(file)
-    audio = audio.set_frame_rate(SAMPLE_RATE)
-    audio = audio.set_channels(1)
 
+def transcribe_file(
+    task: TranscriptionTask,
+    model: EngineModel,
+    transcription_model: str,
+    file: UploadFile,
+    fileName: str,
+    diarize: bool,
+    diarize_max_speakers: Optional[int],
+    source_hash: Optional[str] = None,
+):
+    task.state = TranscriptionState.LOADING
+    pcm_key = f"{source_hash}-{PCM_CACHE_VERSION}"
+    pcm = pcm_cache.get(pcm_key) if source_hash is not None else None
+    if pcm is None:
+        try:
+            stream = WavStream(file)
+        except (wave.Error, EOFError):
+            # everything but PCM wav files is decoded by ffmpeg
+            with measure("decoding"):
+                pcm = decode_file(Path(file.name), fileName)
+        else:
+            task.total = stream.duration_seconds
+            task.audio_duration = stream.duration_seconds
+            task.processed = 0
+            if (
+                not diarize
+                and not use_chunks(stream.duration_seconds)
+                and VAD_GATING == "off"
+            ):
+                # decoded audio goes straight into the recognizer,
+                # so only one decode chunk is held in memory at a time
+                task.state = TranscriptionState.TRANSCRIBING
+                with measure("recognition"):
+                    vosk_result = recognize_blocks(
+                        model,
+                        measure_iter("decoding", stream.chunks(VOSK_BLOCK_SIZE)),
+                        task.set_transcription_progress,
+                        UtteranceParagraphs(task.add_partial_content, fileName, 0),
+                    )
+                return [
+                    transform_vosk_result(
+                        fileName, vosk_result, stream.duration_seconds
+                    )
+                ]
+            # diarization, chunking and gating need random access,
+            # so spool the decoded audio to disk
+            with measure("decoding"):
+                pcm = PcmBuffer.from_chunks(stream.chunks())
+        if source_hash is not None:
+            try:
+                pcm_cache.put(pcm_key, pcm)
+            except OSError:
+                traceback.print_exc()
+
+    with pcm:
+        return transcribe_pcm(
+            task,
+            model,
+            transcription_model,
+            pcm,
+            fileName,
+            diarize,
+            diarize_max_speakers,
+            source_hash,
+        )
+
+
+def transcribe_pcm(
+    task: TranscriptionTask,
+    model: EngineModel,
+    transcription_model: str,
+    pcm: PcmBuffer,
+    fileName: str,
+    diarize: bool,
+    diarize_max_speakers: Optional[int],
+    source_hash: Optional[str] = None,
+):
     # TODO: can we make this atomic?
-    task.total = audio.duration_seconds
+    task.total = pcm.duration_seconds
+    task.audio_duration = pcm.duration_seconds
     task.processed = 0
 
-    if not diarize:
+    if not diarize and use_chunks(pcm.duration_seconds):
         task.state = TranscriptionState.TRANSCRIBING
-        return [
-            transcribe_raw_data(
+        with measure("recognition"):
+            return transcribe_chunked(task, model, transcription_model, pcm, fileName)
+
+    elif not diarize:
+        task.state = TranscriptionState.TRANSCRIBING
+        with measure("recognition"):
+            (vosk_result,) = recognize_ranges(
+                task,
                 model,
-                fileName,
-                audio,
-                0,
-                audio.duration_seconds,
-                task.set_transcription_progress,
+                transcription_model,
+                pcm,
+                [(0, pcm.duration_seconds)],
+                "thread",
+                [UtteranceParagraphs(task.add_partial_content, fileName, 0)],
             )
-        ]
+        return [transform_vosk_result(fileName, vosk_result, pcm.duration_seconds)]
+
+    elif DIARIZATION_MODE == "pipelined":
+        task.state = TranscriptionState.TRANSCRIBING
+        return transcribe_pipelined(
+            task,
+            model,
+            transcription_model,
+            pcm,
+            fileName,
+            diarize_max_speakers,
+            source_hash,
+        )
 
     else:
         task.state = TranscriptionState.DIARIZING
-        try:
-            diarization_model = BinaryKeyDiarizationModel()
-            if diarize_max_speakers is not None:
-                diarization_model.CLUSTERING_SELECTION_MAX_SPEAKERS = (
-                    diarize_max_speakers
+        segments = diarize_pcm(task, pcm, diarize_max_speakers, source_hash)
+        task.state = TranscriptionState.TRANSCRIBING
+        with measure("recognition"):
+            return transcribe_segments(
+                task, model, transcription_model, pcm, segments, fileName
+            )
+
+
+def diarize_pcm(
+    task: TranscriptionTask,
+    pcm: PcmBuffer,
+    max_speakers: Optional[int],
+    source_hash: Optional[str] = None,
+) -> List[Segment]:
+    """Return speaker segments that cover the whole audio without gaps"""
+    try:
+        # this runs in its own thread in the pipelined mode
+        with recording(task), measure("diarization"):
+            segments = get_diarizer(max_speakers).diarize_pcm(pcm, source_hash)
+        optimized_segments = optimize_segments(segments)
+    except:  # noqa: E722
+        traceback.print_exc()
+        optimized_segments = []
+    if optimized_segments:
+        optimized_segments[-1].length = (
+            pcm.duration_seconds - optimized_segments[-1].start
+        )
+    else:
+        optimized_segments = [
+            Segment(start=0, length=pcm.duration_seconds, speaker_id=1)
+        ]
+    return optimized_segments
+
+
+def transcribe_pipelined(
+    task: TranscriptionTask,
+    model: EngineModel,
+    transcription_model: str,
+    pcm: PcmBuffer,
+    fileName: str,
+    diarize_max_speakers: Optional[int],
+    source_hash: Optional[str] = None,
+):
+    """
+    Diarize the audio while the whole audio is transcribed, then assign each
+    word to the speaker segment its center lies in. As the segments don't
+    overlap, that is the segment the word overlaps most with.
+    """
+    with ThreadPoolExecutor(1) as diarization_executor:
+        diarization = diarization_executor.submit(
+            diarize_pcm, task, pcm, diarize_max_speakers, source_hash
+        )
+        with measure("recognition"):
+            if use_chunks(pcm.duration_seconds):
+                words = recognize_chunked(
+                    task, model, transcription_model, pcm, fileName
+                )
+            else:
+                (vosk_result,) = recognize_ranges(
+                    task,
+                    model,
+                    transcription_model,
+                    pcm,
+                    [(0, pcm.duration_seconds)],
+                    "thread",
+                    [UtteranceParagraphs(task.add_partial_content, fileName, 0)],
                 )
-            segments = diarization_model.diarize(
-                SAMPLE_RATE, np.array(audio.get_array_of_samples())
+                words = vosk_result["result"]
+        if not diarization.done():
+            task.state = TranscriptionState.DIARIZING
+        segments = diarization.result()
+
+    segment_starts = [segment.start for segment in segments]
+    segment_words: List[List[dict]] = [[] for _ in segments]
+    for word in words:
+        center = (word["start"] + word["end"]) / 2
+        index = max(bisect.bisect_right(segment_starts, center) - 1, 0)
+        segment = segments[index]
+        # words may reach into the neighbouring segments or, at the seams of
+        # chunks, into the previous word. Clamp them, so the paragraphs tile
+        # the audio like in the sequential mode.
+        previous_end = segment_words[index][-1]["end"] if segment_words[index] else 0
+        start = min(max(word["start"] - segment.start, previous_end), segment.length)
+        end = min(max(word["end"] - segment.start, start), segment.length)
+        segment_words[index].append({**word, "start": start, "end": end})
+
+    return [
+        transform_vosk_result(
+            speaker_name(fileName, segment.speaker_id),
+            {"result": words},
+            segment.length,
+            segment.start,
+        )
+        for segment, words in zip(segments, segment_words)
+    ]
+
+
+def transcribe_segments(
+    task: TranscriptionTask,
+    model: EngineModel,
+    transcription_model: str,
+    pcm: PcmBuffer,
+    segments: List[Segment],
+    fileName: str,
+    executor: str = TRANSCRIPTION_EXECUTOR,
+):
+    names = [speaker_name(fileName, segment.speaker_id) for segment in segments]
+    vosk_results = recognize_ranges(
+        task,
+        model,
+        transcription_model,
+        pcm,
+        [(segment.start, segment.length) for segment in segments],
+        executor,
+        [
+            UtteranceParagraphs(task.add_partial_content, name, segment.start)
+            for name, segment in zip(names, segments)
+        ],
+    )
+    return [
+        transform_vosk_result(name, vosk_result, segment.length, segment.start)
+        for name, segment, vosk_result in zip(names, segments, vosk_results)
+    ]
+
+
+def transcribe_chunked(
+    task: TranscriptionTask,
+    model: EngineModel,
+    transcription_model: str,
+    pcm: PcmBuffer,
+    fileName: str,
+    executor: str = TRANSCRIPTION_EXECUTOR,
+):
+    words = recognize_chunked(task, model, transcription_model, pcm, fileName, executor)
+    return [transform_vosk_result(fileName, {"result": words}, pcm.duration_seconds)]
+
+
+def recognize_chunked(
+    task: TranscriptionTask,
+    model: EngineModel,
+    transcription_model: str,
+    pcm: PcmBuffer,
+    fileName: str,
+    executor: str = TRANSCRIPTION_EXECUTOR,
+) -> List[dict]:
+    """Recognize the words of the whole audio in parallel chunks"""
+    with measure("chunk_planning"):
+        chunks = plan_chunks(pcm, TRANSCRIPTION_CHUNK_LENGTH)
+    ranges = [
+        (chunk.decode_start, chunk.decode_end - chunk.decode_start) for chunk in chunks
+    ]
+    # overlapping parts are decoded twice, so they count twice for the progress
+    task.total = sum(duration for _, duration in ranges)
+
+    vosk_results = recognize_ranges(
+        task,
+        model,
+        transcription_model,
+        pcm,
+        ranges,
+        executor,
+        [
+            UtteranceParagraphs(
+                task.add_partial_content,
+                fileName,
+                chunk.decode_start,
+                chunk.start,
+                chunk.end,
             )
-            optimized_segments = optimize_segments(segments)
-        except:  # noqa: E722
-            traceback.print_exc()
-            optimized_segments = []
-        if optimized_segments:
-            optimized_segments[-1].length = (
-                audio.duration_seconds - optimized_segments[-1].start
+            for chunk in chunks
+        ],
+    )
+
+    # words in the overlaps are recognized twice: keep the word from the chunk
+    # its center lies in, so the merged list neither loses nor repeats words
+    words = []
+    for chunk, vosk_result in zip(chunks, vosk_results):
+        for word in vosk_result.get("result", []):
+            word = {
+                **word,
+                "start": word["start"] + chunk.decode_start,
+                "end": word["end"] + chunk.decode_start,
+            }
+            center = (word["start"] + word["end"]) / 2
+            if chunk.start <= center < chunk.end:
+                words.append(word)
+    return words
+
+
+@dataclass
+class Chunk:
+    start: float
+    end: float
+    decode_start: float
+    decode_end: float
+
+
+def plan_chunks(pcm: PcmBuffer, chunk_length: float) -> List[Chunk]:
+    """
+    Split the audio into chunks of roughly `chunk_length` seconds.
+
+    Chunks are split in the middle of a pause near the target boundary if
+    one can be found. Otherwise the chunks are split at the target boundary
+    and decoded with some overlap, so words at the seam are recognized by
+    at least one of the chunks.
+    """
+    duration = pcm.duration_seconds
+    boundaries = [0.0]
+    at_pause = [True]
+    while duration - boundaries[-1] > 1.5 * chunk_length:
+        target = boundaries[-1] + chunk_length
+        pause = find_pause(
+            pcm, target - CHUNK_PAUSE_SEARCH_WINDOW, target + CHUNK_PAUSE_SEARCH_WINDOW
+        )
+        boundaries.append(pause if pause is not None else target)
+        at_pause.append(pause is not None)
+    boundaries.append(duration)
+    at_pause.append(True)
+
+    return [
+        Chunk(
+            start=start,
+            end=end,
+            decode_start=max(start - (0 if start_at_pause else CHUNK_OVERLAP), 0),
+            decode_end=min(end + (0 if end_at_pause else CHUNK_OVERLAP), duration),
+        )
+        for start, end, start_at_pause, end_at_pause in zip(
+            boundaries, boundaries[1:], at_pause, at_pause[1:]
+        )
+    ]
+
+
+def recognize_ranges(
+    task: TranscriptionTask,
+    model: EngineModel,
+    transcription_model: str,
+    pcm: PcmBuffer,
+    ranges: List[Tuple[float, float]],
+    executor: str = TRANSCRIPTION_EXECUTOR,
+    words_callbacks: Optional[List[WordsCallback]] = None,
+) -> List[dict]:
+    """
+    Run the recognizer on the (offset, duration) ranges in parallel.
+    The words of each range are passed to its callback in `words_callbacks`
+    as they are recognized.
+    """
+    if words_callbacks is None:
+        words_callbacks = [lambda _: None] * len(ranges)
+
+    if executor == "process":
+        # the workers map the same pcm file, so no audio is pickled
+        description = models.get_model_description(transcription_model)
+        futures = []
+        for (offset, duration), words_callback in zip(ranges, words_callbacks):
+            future = submit_to_process_pool(
+                transcription_model,
+                _recognize_segment,
+                description.engine,
+                str(description.path()),
+                description.engine_options,
+                str(pcm.path),
+                offset,
+                duration,
             )
-        else:
-            optimized_segments = [
-                Segment(start=0, length=audio.duration_seconds, speaker_id=1)
-            ]
-        with ThreadPoolExecutor() as executor:
-            task.state = TranscriptionState.TRANSCRIBING
-            return list(
-                executor.map(
-                    lambda segment: transcribe_raw_data(
-                        model,
-                        f"Speaker {int(segment.speaker_id)} ({fileName})",
-                        audio,
-                        segment.start,
-                        segment.length,
-                        task.set_transcription_progress,
-                    ),
-                    optimized_segments,
+            future.add_done_callback(
+                lambda future, duration=duration, words_callback=words_callback: (
+                    _segment_done(task, future, duration, words_callback)
                 )
             )
+            futures.append(future)
+        results = [future.result() for future in futures]
+    else:
+        # the ranges of all transcriptions with this model share one pool of workers
+        results = recognition.map(
+            transcription_model,
+            [
+                functools.partial(
+                    recognize_range,
+                    model,
+                    pcm,
+                    offset,
+                    duration,
+                    task.set_transcription_progress,
+                    words_callback,
+                )
+                for (offset, duration), words_callback in zip(ranges, words_callbacks)
+            ],
+        )
+
+    skipped = sum(result.get("skipped", 0) for result in results)
+    if skipped > 0:
+        task.skipped_silence += skipped
+        metrics.add("audapolis_skipped_silence_seconds_total", skipped)
+    return results
+
+
+def _segment_done(task: TranscriptionTask, future, duration, words_callback):
+    # results only come back from worker processes once the whole segment is done
+    if not future.cancelled() and future.exception() is None:
+        words_callback(future.result().get("result", []))
+    task.set_transcription_progress(duration)
+
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_process_pool_lock = threading.Lock()
+# futures of the process pool that aren't done, so they can be canceled
+_process_futures: Set[Future] = set()
+# ids of the models that workers of the process pool may have loaded
+_process_pool_models: Set[str] = set()
+
+# ((engine, path, options), model) of the model loaded by the current process if
+# it is a process pool worker
+_worker_model: Optional[Tuple[tuple, EngineModel]] = None
+
+
+def submit_to_process_pool(model_id: str, fn, *args) -> Future:
+    """Run `fn(*args)` in the process pool, `fn` loads the model `model_id`"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(TRANSCRIPTION_WORKERS)
+        future = _process_pool.submit(fn, *args)
+        _process_futures.add(future)
+        _process_pool_models.add(model_id)
+    future.add_done_callback(_forget_process_future)
+    return future
+
+
+def _forget_process_future(future: Future):
+    with _process_pool_lock:
+        _process_futures.discard(future)
+
+
+def shutdown_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        pool, _process_pool = _process_pool, None
+        futures = list(_process_futures)
+        _process_pool_models.clear()
+    if pool is not None:
+        # `shutdown` only cancels futures that didn't start yet since python 3.9
+        for future in futures:
+            future.cancel()
+        pool.shutdown()
+
+
+def recycle_process_pool(model_id: str):
+    """
+    Replace the process pool if its workers may have loaded `model_id`.
+
+    Called when the model is evicted from the model cache, so the copies in the
+    workers are freed as well. Segments that were already submitted are still
+    recognized by the old workers, which exit once they are done.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None or model_id not in _process_pool_models:
+            return
+        pool, _process_pool = _process_pool, None
+        _process_pool_models.clear()
+    pool.shutdown(wait=False)
+
+
+def _recognize_segment(
+    engine: str, model_path: str, engine_options: dict, pcm_path: str, offset, duration
+) -> dict:
+    global _worker_model
+    # each worker keeps the model for later segments, but only the last one it
+    # used, so a worker never holds more than one model. The listings of
+    # multilingual models share their path, but not their options.
+    key = (engine, model_path, engine_options)
+    if _worker_model is None or _worker_model[0] != key:
+        _worker_model = None
+        _worker_model = (key, load_model(engine, Path(model_path), engine_options))
+    pcm = PcmBuffer(Path(pcm_path), delete=False)
+    try:
+        return recognize_range(_worker_model[1], pcm, offset, duration, lambda _: None)
+    finally:
+        pcm.close()
+
+
+def speaker_name(file_name: str, speaker_id: Optional[int] = None) -> str:
+    """The speaker of paragraphs of `file_name`, `speaker_id` is set if diarized"""
+    if speaker_id is None:
+        return file_name
+    return f"Speaker {int(speaker_id)} ({file_name})"
+
+
+def rename_speakers(content: List[dict], old_name: str, new_name: str) -> List[dict]:
+    """Replace the file name in the speakers of a transcription of `old_name`"""
+    diarized = re.compile(rf"Speaker (\d+) \({re.escape(old_name)}\)")
+    renamed = []
+    for paragraph in content:
+        speaker = paragraph["speaker"]
+        match = diarized.fullmatch(speaker)
+        if speaker == old_name:
+            speaker = speaker_name(new_name)
+        elif match is not None:
+            speaker = speaker_name(new_name, int(match[1]))
+        renamed.append({**paragraph, "speaker": speaker})
+    return renamed
 
 
 def transform_vosk_result(
@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Callable, List, Optional
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import numpy as np  # noqa: E402
+from synthetic_audio import speech_like, write_wav  # noqa: E402
+
+from app.audio import PcmBuffer  # noqa: E402
+from app.metrics import peak_rss, recording  # noqa: E402
+from app.models import models  # noqa: E402
+from app.transcribe import (  # noqa: E402
+    TranscriptionState,
+    TranscriptionTask,
+    transcribe,
+    transcribe_raw_data,
+    transform_vosk_result,
+)
+
+# Bump this if the structure of the json output changes
+BENCHMARK_FORMAT_VERSION = 1
+
+
+def run_transcription(
+    model_id: str,
+    path: Path,
+    diarize: bool,
+    max_speakers: Optional[int],
+    trace_allocations: bool,
+) -> dict:
+    """Transcribe `path` once. Runs in a fresh process, so the peak RSS is its own."""
+    models.get(model_id)
+    baseline_rss = peak_rss()
+    task = TranscriptionTask(path.name, TranscriptionState.QUEUED)
+    if trace_allocations:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with open(path, "rb") as file, recording(task):
+        transcribe(task, model_id, file, path.name, task.uuid, diarize, max_speakers)
+    elapsed = time.perf_counter() - start
+    result = {
+        "wall": elapsed,
+        "realtime_factor": elapsed / task.audio_duration,
+        "timings": task.timings,
+        "cpu_times": task.cpu_times,
+        "decoded_bytes": task.decoded_bytes,
+        "skipped_silence": task.skipped_silence,
+        "baseline_rss": baseline_rss,
+        "peak_rss": peak_rss(),
+    }
+    if trace_allocations:
+        result["traced_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def benchmark_function(fn: Callable, runs: int) -> dict:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    # tracing slows python down a lot, so allocations are measured in an extra run
+    tracemalloc.start()
+    fn()
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "traced_peak_bytes": traced_peak,
+    }
+
+
+def synthetic_vosk_result(seconds: float, seed: int = 0) -> dict:
+    """A vosk result with words of speech-like lengths and pauses"""
+    rng = np.random.default_rng(seed)
+    words = []
+    position = 0.0
+    while True:
+        position += rng.uniform(0, 0.5)
+        end = position + rng.uniform(0.1, 0.6)
+        if end > seconds:
+            break
+        words.append({"word": "word", "start": position, "end": end, "conf": 1.0})
+        position = end
+    return {"result": words}
+
+
+def benchmark_functions(model_id: str, length: float, runs: int) -> dict:
+    results = {}
+
+    model = models.get(model_id)
+    with PcmBuffer.from_chunks([speech_like(length).tobytes()]) as pcm:
+        results["transcribe_raw_data"] = benchmark_function(
+            lambda: transcribe_raw_data(
+                model, "benchmark", pcm, 0, pcm.duration_seconds, lambda _: None
+            ),
+            runs,
+        )
+
+    vosk_result = synthetic_vosk_result(length)
+    results["transform_vosk_result"] = benchmark_function(
+        lambda: transform_vosk_result("benchmark", vosk_result, length), runs
+    )
+
+    try:
+        from app.otio import Segment, convert_otio
+    except ImportError as e:
+        # OpenTimelineIO is an optional dependency
+        results["convert_otio"] = {"skipped": str(e)}
+    else:
+        paragraph = transform_vosk_result("benchmark", vosk_result, length)
+        timeline = [
+            Segment(
+                speaker=f"Speaker {i % 2}",
+                source_file="benchmark.wav",
+                source_length=length,
+                has_video=False,
+                source_start=item["sourceStart"],
+                length=item["length"],
+            )
+            for i, item in enumerate(paragraph["content"])
+        ]
+        results["convert_otio"] = benchmark_function(
+            lambda: convert_otio(timeline, "benchmark", "otio_json"), runs
+        )
+
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(runs: List[dict]) -> dict:
+    return {
+        "wall": statistics.median(run["wall"] for run in runs),
+        "realtime_factor": statistics.median(run["realtime_factor"] for run in runs),
+        "peak_rss": max(run["peak_rss"] or 0 for run in runs),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the transcription pipeline on synthetic audio "
+        "and write the results as json"
+    )
+    parser.add_argument("model", help="id of a small downloaded transcription model")
+    parser.add_argument(
+        "--lengths", type=float, nargs="+", default=[30, 300], help="in s"
+    )
+    parser.add_argument("--sample-rate", type=int, default=44100)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--max-speakers", type=int)
+    parser.add_argument(
+        "--function-length",
+        type=float,
+        default=60,
+        help="audio length in s for the function benchmarks",
+    )
+    parser.add_argument(
+        "--trace-allocations",
+        action="store_true",
+        help="trace allocations of whole transcriptions, this slows them down a lot",
+    )
+    parser.add_argument("--output", type=Path, help="defaults to stdout")
+    args = parser.parse_args()
+
+    results = {
+        "version": BENCHMARK_FORMAT_VERSION,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "model": args.model,
+        "sample_rate": args.sample_rate,
+        "transcriptions": [],
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        for length in args.lengths:
+            path = Path(directory) / f"synthetic_{length:g}s.wav"
+            write_wav(path, speech_like(length), args.sample_rate)
+            for diarize in [False, True]:
+                runs = []
+                for run in range(args.runs):
+                    # every run gets a fresh process, so the model is loaded
+                    # before it is measured and the peak RSS isn't shared
+                    with ProcessPoolExecutor(1, get_context("spawn")) as process:
+                        runs.append(
+                            process.submit(
+                                run_transcription,
+                                args.model,
+                                path,
+                                diarize,
+                                args.max_speakers,
+                                args.trace_allocations,
+                            ).result()
+                        )
+                    print(
+                        f"{length:g}s diarize={diarize} run {run}: "
+                        f"{runs[-1]['wall']:.2f}s, "
+                        f"realtime factor {runs[-1]['realtime_factor']:.3f}",
+                        file=sys.stderr,
+                    )
+                results["transcriptions"].append(
+                    {
+                        "length": length,
+                        "diarize": diarize,
+                        "summary": summarize(runs),
+                        "runs": runs,
+                    }
+                )
+
+    results["functions"] = benchmark_functions(
+        args.model, args.function_length, args.runs
+    )
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        args.output.write_text(output)
@@ -0,0 +1,53 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from pydiar.models import Segment  # noqa: E402
+from synthetic_audio import speech_like  # noqa: E402
+
+from app.audio import PcmBuffer  # noqa: E402
+from app.models import models  # noqa: E402
+from app.transcribe import (  # noqa: E402
+    TranscriptionState,
+    TranscriptionTask,
+    shutdown_process_pool,
+    transcribe_segments,
+)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare thread and process mode for transcribing speaker segments"
+    )
+    parser.add_argument("model", help="id of a downloaded transcription model")
+    parser.add_argument("--length", type=float, default=600, help="audio length in s")
+    parser.add_argument("--segments", type=int, default=32)
+    parser.add_argument("--runs", type=int, default=2)
+    args = parser.parse_args()
+
+    model = models.get(args.model)
+    pcm = PcmBuffer.from_chunks([speech_like(args.length).tobytes()])
+    segment_length = pcm.duration_seconds / args.segments
+    segments = [
+        Segment(start=i * segment_length, length=segment_length, speaker_id=i % 4)
+        for i in range(args.segments)
+    ]
+
+    with pcm:
+        for executor in ["thread", "process"]:
+            for run in range(args.runs):
+                task = TranscriptionTask("benchmark", TranscriptionState.TRANSCRIBING)
+                task.total = pcm.duration_seconds
+                start = time.perf_counter()
+                transcribe_segments(
+                    task, model, args.model, pcm, segments, "benchmark", executor
+                )
+                elapsed = time.perf_counter() - start
+                # the first process mode run includes loading the model in the workers
+                print(
+                    f"{executor} run {run}: {elapsed:.2f}s, "
+                    f"{pcm.duration_seconds / elapsed:.1f}x realtime"
+                )
+        shutdown_process_pool()
@@ -0,0 +1,71 @@
+import argparse
+import functools
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from synthetic_audio import speech_like  # noqa: E402
+
+from app.audio import PcmBuffer  # noqa: E402
+from app.models import models  # noqa: E402
+from app.recognition import recognition  # noqa: E402
+from app.transcribe import VOSK_BLOCK_SIZE, recognize_blocks  # noqa: E402
+
+
+def job_calls(model, pcm: PcmBuffer, chunks: int):
+    chunk_length = pcm.duration_seconds / chunks
+    return [
+        functools.partial(
+            recognize_blocks,
+            model,
+            pcm.blocks(i * chunk_length, chunk_length, VOSK_BLOCK_SIZE),
+            lambda _: None,
+        )
+        for i in range(chunks)
+    ]
+
+
+def run_separate(model, model_id, pcm, chunks):
+    # how jobs ran before the recognition service: each with its own threads
+    with ThreadPoolExecutor(recognition.workers) as pool:
+        return list(pool.map(lambda call: call(), job_calls(model, pcm, chunks)))
+
+
+def run_shared(model, model_id, pcm, chunks):
+    return recognition.map(model_id, job_calls(model, pcm, chunks))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the recognition throughput of concurrent transcriptions"
+    )
+    parser.add_argument("model", help="id of a downloaded transcription model")
+    parser.add_argument("--length", type=float, default=120, help="audio length in s")
+    parser.add_argument("--chunks", type=int, default=4, help="ranges per job")
+    parser.add_argument("--max-jobs", type=int, default=8)
+    args = parser.parse_args()
+
+    model = models.get(args.model)
+    pcm = PcmBuffer.from_chunks([speech_like(args.length).tobytes()])
+
+    print(f"{recognition.workers} recognition workers")
+    with pcm:
+        for mode, run in [("separate", run_separate), ("shared", run_shared)]:
+            jobs = 1
+            while jobs <= args.max_jobs:
+                start = time.perf_counter()
+                with ThreadPoolExecutor(jobs) as clients:
+                    for _ in clients.map(
+                        lambda _: run(model, args.model, pcm, args.chunks),
+                        range(jobs),
+                    ):
+                        pass
+                elapsed = time.perf_counter() - start
+                print(
+                    f"{mode} {jobs} jobs: {elapsed:.2f}s, "
+                    f"{jobs * pcm.duration_seconds / elapsed:.1f} audio s / s"
+                )
+                jobs *= 2
@@ -7,6 +7,25 @@ from bs4 import BeautifulSoup
 
 HARDCODED_MODELS = []
 
+# faster-whisper models are multilingual, so they are listed for every language
+# they work well for, with the language in their engine options. The languages
+# share the downloaded files, see `ModelDescription.file_name`.
+WHISPER_LANGUAGES = {
+    "English": "en",
+    "Russian": "ru",
+    "French": "fr",
+    "German": "de",
+    "Spanish": "es",
+    "Portuguese/Brazilian Portuguese": "pt",
+    "Italian": "it",
+    "Dutch": "nl",
+}
+WHISPER_MODELS = [
+    ("whisper-base", "Systran/faster-whisper-base", "145M"),
+    ("whisper-small", "Systran/faster-whisper-small", "484M"),
+]
+WHISPER_FILES = ["config.json", "model.bin", "tokenizer.json", "vocabulary.txt"]
+
 r = requests.get("https://alphacephei.com/vosk/models")
 assert r.status_code == 200
 soup = BeautifulSoup(r.content, "html.parser")
@@ -50,6 +69,22 @@ for row in rows:
         )
         models += [model]
 
+for lang, language_code in WHISPER_LANGUAGES.items():
+    for name, repository, size in WHISPER_MODELS:
+        url = f"https://huggingface.co/{repository}"
+        model = dict(
+            lang=lang,
+            name=name,
+            url=url,
+            description="Multilingual Whisper model, needs faster-whisper",
+            size=size,
+            type="transcription",
+            engine="faster-whisper",
+            engine_options={"language": language_code},
+            files=[f"{url}/resolve/main/{file}" for file in WHISPER_FILES],
+        )
+        models += [model]
+
 
 def print_table_from_dict_list(dict_list, columns=None):
     from rich.console import Console
@@ -1,33 +1,40 @@
 import argparse
-import time
 
-import requests
 from rich.live import Live
 from rich.table import Table
+from task_events import task_events
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--server", default="http://127.0.0.1:8000")
+parser.add_argument("--token")
 args = parser.parse_args()
 
+headers = {}
+if args.token:
+    headers["Authorization"] = f"Bearer {args.token}"
 
-def generate_table() -> Table:
+
+def generate_table(tasks) -> Table:
     """Make a new table."""
-    tasks = requests.get(f"{args.server}/tasks/list/")
     table = Table(title="Tasks")
 
     table.add_column("UUID")
     table.add_column("Filename")
     table.add_column("State")
 
-    for task in tasks.json():
+    for task in sorted(tasks.values(), key=lambda x: x["uuid"]):
         state = task["state"]
         if state == "transcribing":
             state += f" ({task['processed']/task['total']:%}%)"
-        table.add_row(task["uuid"], task["filename"], state)
+        table.add_row(task["uuid"], task.get("filename", ""), state)
     return table
 
 
-with Live(generate_table(), refresh_per_second=4) as live:
-    while True:
-        time.sleep(0.1)
-        live.update(generate_table())
+tasks = {}
+with Live(generate_table(tasks), refresh_per_second=4) as live:
+    for event, task in task_events(args.server, headers):
+        if event == "delete":
+            tasks.pop(task["uuid"], None)
+        else:
+            tasks[task["uuid"]] = task
+        live.update(generate_table(tasks))
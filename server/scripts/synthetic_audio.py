@@ -0,0 +1,55 @@
+import audioop
+import wave
+from pathlib import Path
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+
+def speech_like(seconds: float, seed: int = 0) -> np.ndarray:
+    """
+    Generate deterministic 16kHz mono int16 audio that roughly looks like speech.
+
+    The signal consists of "syllables" of harmonic tones with a moving pitch,
+    grouped into "utterances" separated by pauses. It is not intelligible, but
+    it exercises VAD, diarization and the recognizer like real speech does.
+    """
+    rng = np.random.default_rng(seed)
+    out = np.zeros(int(seconds * SAMPLE_RATE), dtype=np.float32)
+
+    position = 0
+    while position < len(out):
+        # a pause followed by an utterance of several syllables
+        position += int(rng.uniform(0.2, 1.5) * SAMPLE_RATE)
+        pitch = rng.uniform(90, 220)
+        for _ in range(rng.integers(3, 15)):
+            length = int(rng.uniform(0.1, 0.3) * SAMPLE_RATE)
+            end = min(position + length, len(out))
+            if end <= position:
+                break
+            t = np.arange(end - position) / SAMPLE_RATE
+            f0 = pitch * (1 + 0.1 * np.sin(2 * np.pi * rng.uniform(2, 6) * t))
+            phase = 2 * np.pi * np.cumsum(f0) / SAMPLE_RATE
+            syllable = sum(
+                np.sin(harmonic * phase) / harmonic for harmonic in range(1, 8)
+            )
+            syllable *= np.hanning(len(t))
+            out[position:end] += syllable
+            position = end + int(rng.uniform(0, 0.05) * SAMPLE_RATE)
+
+    out += rng.normal(0, 0.01, len(out))
+    out /= max(np.abs(out).max(), 1e-9)
+    return (out * 0.5 * np.iinfo(np.int16).max).astype(np.int16)
+
+
+def write_wav(path: Path, samples: np.ndarray, sample_rate: int = SAMPLE_RATE):
+    """Write 16kHz mono int16 `samples` to a wav file with `sample_rate`"""
+    data = samples.tobytes()
+    if sample_rate != SAMPLE_RATE:
+        data, _ = audioop.ratecv(data, 2, 1, SAMPLE_RATE, sample_rate, None)
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(data)
@@ -0,0 +1,26 @@
+import json
+from typing import Iterator, Optional, Tuple
+
+import requests
+
+
+def task_events(
+    server: str, headers: dict, task_uuid: Optional[str] = None, rate: float = 4
+) -> Iterator[Tuple[str, dict]]:
+    """Yield (event, data) for the server-sent task events of the server"""
+    params = {"rate": rate}
+    if task_uuid is not None:
+        params["task_uuid"] = task_uuid
+    with requests.get(
+        f"{server}/tasks/events/", params=params, headers=headers, stream=True
+    ) as response:
+        response.raise_for_status()
+        event, data = "message", []
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[len("event:") :].strip()
+            elif line.startswith("data:"):
+                data.append(line[len("data:") :].strip())
+            elif not line and data:
+                yield event, json.loads("\n".join(data))
+                event, data = "message", []
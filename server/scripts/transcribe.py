@@ -1,15 +1,13 @@
 import argparse
 import hashlib
 import json
-import subprocess
-import tempfile
-import time
 import uuid
 import zipfile
 from pathlib import Path
 
 import requests
 import tqdm
+from task_events import task_events
 
 
 def sha256sum(filename, blocksize=65536):
@@ -101,17 +99,11 @@ if __name__ == "__main__":
     if args.token:
         headers["Authorization"] = f"Bearer {args.token}"
 
-    tmpfile = tempfile.NamedTemporaryFile(suffix=".wav")
-    if args.file.suffix != ".wav":
-        subprocess.check_call(["ffmpeg", "-y", "-i", str(args.file), tmpfile.name])
-        server_file = tmpfile.name
-    else:
-        server_file = args.file
-
+    # the server decodes any audio or video file itself
     print(f"Uploading {args.file}")
     upload_req = requests.post(
         f"{args.server}/tasks/start_transcription/",
-        files={"file": open(server_file, "rb")},
+        files={"file": open(args.file, "rb")},
         params={
             "transcription_model": f"transcription-{args.language}-{args.transcription_model}",
             "diarize": args.diarize,
@@ -120,24 +112,27 @@ if __name__ == "__main__":
         headers=headers,
     )
 
+    task_uuid = upload_req.json()["uuid"]
     pbar = tqdm.tqdm(total=100)
 
-    while True:
-        status_req = requests.get(
-            f"{args.server}/tasks/{upload_req.json()['uuid']}/", headers=headers
-        )
-        if status_req.json()["state"] == "done":
+    for event, task in task_events(args.server, headers, task_uuid):
+        if event == "delete":
+            raise SystemExit("The task was deleted on the server")
+        if task["state"] == "failed":
+            pbar.close()
+            raise SystemExit(f"The transcription failed: {task['error']}")
+        if task["state"] == "done":
             break
-
-        time.sleep(0.1)
-
-        pbar.update((status_req.json()["progress"] * 100) - pbar.n)
-        pbar.set_description(status_req.json()["state"])
+        pbar.update((task["progress"] * 100) - pbar.n)
+        pbar.set_description(task["state"])
 
     pbar.update(100 - pbar.n)
     pbar.close()
 
-    content = status_req.json()["content"]
+    result_req = requests.get(
+        f"{args.server}/tasks/{task_uuid}/result/", headers=headers
+    )
+    content = result_req.json()
     source_hash = sha256sum(args.file)
 
     output_file = args.file.with_suffix(".audapolis")
@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# the config is read when the app is imported, so the data and cache dirs
+# have to be set before any test module imports it
+_directory = tempfile.mkdtemp(prefix="audapolis-tests-")
+os.environ["AUDAPOLIS_DATA_DIR"] = os.path.join(_directory, "data")
+os.environ["AUDAPOLIS_CACHE_DIR"] = os.path.join(_directory, "cache")
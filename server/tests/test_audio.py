@@ -0,0 +1,197 @@
+import errno
+import os
+import struct
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app import audio, transcribe
+from app.audio import (
+    SAMPLE_RATE,
+    SAMPLE_WIDTH,
+    DecodeError,
+    PcmBuffer,
+    PcmCache,
+    decode_file,
+    speech_ranges,
+)
+
+
+def wav(fmt_chunk: bytes, data: bytes) -> bytes:
+    chunks = (
+        b"fmt "
+        + struct.pack("<I", len(fmt_chunk))
+        + fmt_chunk
+        + b"data"
+        + struct.pack("<I", len(data))
+        + data
+    )
+    return b"RIFF" + struct.pack("<I", 4 + len(chunks)) + b"WAVE" + chunks
+
+
+@pytest.fixture
+def no_ffmpeg(monkeypatch):
+    monkeypatch.setattr(audio, "FFMPEG", "audapolis-missing-ffmpeg")
+
+
+def test_decode_without_ffmpeg_rejects_other_formats(no_ffmpeg, tmp_path):
+    path = tmp_path / "upload"
+    path.write_bytes(b"ID3\x04\x00" + bytes(100))
+    with pytest.raises(DecodeError, match="ffmpeg is required to decode mp3 files"):
+        decode_file(path, "talk.MP3")
+
+
+def test_decode_without_ffmpeg_rejects_unsupported_wav(no_ffmpeg, tmp_path):
+    path = tmp_path / "upload"
+    # 32 bit float samples
+    fmt = struct.pack("<HHIIHH", 3, 1, SAMPLE_RATE, 4 * SAMPLE_RATE, 4, 32)
+    path.write_bytes(wav(fmt, np.zeros(1600, dtype=np.float32).tobytes()))
+    with pytest.raises(DecodeError, match="ffmpeg is required"):
+        decode_file(path, "talk.wav")
+
+
+def test_decode_without_ffmpeg_reads_extensible_wav(no_ffmpeg, tmp_path):
+    path = tmp_path / "upload"
+    samples = np.arange(-800, 800, dtype=np.int16)
+    # WAVE_FORMAT_EXTENSIBLE with the PCM subformat, the wave module can't read
+    # it before python 3.12, pydub can
+    fmt = struct.pack(
+        "<HHIIHHHHI16s",
+        0xFFFE,
+        1,
+        SAMPLE_RATE,
+        2 * SAMPLE_RATE,
+        2,
+        16,
+        22,
+        16,
+        4,
+        b"\x01\x00\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71",
+    )
+    path.write_bytes(wav(fmt, samples.tobytes()))
+    with decode_file(path, "talk.wav") as pcm:
+        assert np.array_equal(pcm.samples, samples)
+
+
+def spooled(samples: np.ndarray) -> PcmBuffer:
+    return PcmBuffer.from_chunks([samples.astype(np.int16).tobytes()])
+
+
+def test_pcm_cache_takes_over_the_spooled_file(tmp_path):
+    cache = PcmCache(tmp_path, 1024 * 1024)
+    samples = np.arange(1000)
+    with spooled(samples) as pcm:
+        cache.put("key", pcm)
+        # the same file under a second name, not a copy
+        assert os.path.samefile(pcm.path, cache.path("key"))
+    assert not pcm.path.exists()
+    with cache.get("key") as cached:
+        assert np.array_equal(cached.samples, samples)
+    assert cache.path("key").exists()
+
+
+def test_pcm_cache_copies_across_file_systems(tmp_path, monkeypatch):
+    cache = PcmCache(tmp_path, 1024 * 1024)
+
+    def link(source, target):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+    monkeypatch.setattr(os, "link", link)
+    samples = np.arange(1000)
+    with spooled(samples) as pcm:
+        cache.put("key", pcm)
+        assert not os.path.samefile(pcm.path, cache.path("key"))
+    with cache.get("key") as cached:
+        assert np.array_equal(cached.samples, samples)
+    assert [path.suffix for path in tmp_path.iterdir()] == [".pcm"]
+
+
+def test_pcm_cache_evicts_least_recently_used(tmp_path):
+    size = 1000 * SAMPLE_WIDTH
+    cache = PcmCache(tmp_path, 2 * size)
+    for key in ["a", "b"]:
+        with spooled(np.zeros(1000)) as pcm:
+            cache.put(key, pcm)
+    cache.get("a").close()
+    with spooled(np.zeros(1000)) as pcm:
+        cache.put("c", pcm)
+    assert cache.get("b") is None
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a.pcm", "c.pcm"]
+
+
+def test_pcm_cache_disabled(tmp_path):
+    cache = PcmCache(tmp_path / "pcm", 0)
+    with spooled(np.zeros(10)) as pcm:
+        cache.put("key", pcm)
+    assert cache.get("key") is None
+    assert not (tmp_path / "pcm").exists()
+
+
+def speech(monkeypatch, frames: int, *runs):
+    """Let the VAD find speech in the `runs` of (first, last + 1) frames"""
+    is_speech = np.zeros(frames, dtype=bool)
+    for first, end in runs:
+        is_speech[first:end] = True
+    monkeypatch.setattr(audio, "speech_frames", lambda *args: is_speech)
+
+
+def approx_ranges(ranges):
+    return [pytest.approx(r) for r in ranges]
+
+
+def test_speech_ranges_are_padded(monkeypatch):
+    speech(monkeypatch, 2000, (100, 200))
+    assert speech_ranges(None, 0, 60) == approx_ranges([(2.7, 6.3)])
+    # times are relative to the start of the audio
+    assert speech_ranges(None, 100, 160) == approx_ranges([(102.7, 106.3)])
+
+
+def test_short_non_speech_is_kept(monkeypatch):
+    # 0.9 seconds between the runs, 0.3 seconds between the padded ranges
+    speech(monkeypatch, 2000, (100, 200), (230, 300))
+    assert speech_ranges(None, 0, 60) == approx_ranges([(2.7, 9.3)])
+    speech(monkeypatch, 2000, (100, 200), (400, 500))
+    assert speech_ranges(None, 0, 60) == approx_ranges([(2.7, 6.3), (11.7, 15.3)])
+
+
+def test_speech_ranges_near_the_edges_extend_to_them(monkeypatch):
+    speech(monkeypatch, 2000, (10, 50), (1900, 1960))
+    assert speech_ranges(None, 0, 60) == approx_ranges([(0, 1.8), (56.7, 60)])
+
+
+def test_no_speech_no_ranges(monkeypatch):
+    pcm = PcmBuffer.from_chunks([bytes(10 * SAMPLE_RATE * SAMPLE_WIDTH)])
+    with pcm:
+        assert speech_ranges(pcm, 0, 10) == []
+    speech(monkeypatch, 2000)
+    assert speech_ranges(None, 0, 60) == []
+
+
+class SingleWordRecognizer:
+    """Recognizes one word half a second into every stream"""
+
+    def accept(self, block):
+        return None
+
+    def finish(self):
+        return [{"word": "word", "start": 0.5, "end": 1.0, "conf": 1.0}]
+
+
+def test_gated_recognition_skips_non_speech(monkeypatch):
+    monkeypatch.setattr(transcribe, "VAD_GATING", "on")
+    monkeypatch.setattr(
+        transcribe, "speech_ranges", lambda pcm, start, end: [(12, 15), (20, 22)]
+    )
+    model = SimpleNamespace(recognizer=SingleWordRecognizer)
+    progress = []
+    pcm = PcmBuffer.from_chunks([bytes(40 * SAMPLE_RATE * SAMPLE_WIDTH)])
+    with pcm:
+        result = transcribe.recognize_range(model, pcm, 10, 20, progress.append)
+    # times are relative to the offset of the range
+    assert [(w["start"], w["end"]) for w in result["result"]] == [
+        (2.5, 3.0),
+        (10.5, 11.0),
+    ]
+    assert result["skipped"] == pytest.approx(15)
+    assert sum(progress) == pytest.approx(20)
@@ -0,0 +1,218 @@
+import hashlib
+import http.server
+import os
+import re
+import threading
+
+import pytest
+
+from app import download
+from app.config import DOWNLOAD_DIR
+from app.download import ChecksumMismatch, PartialDownload
+from app.models import (
+    DownloadModelState,
+    DownloadModelTask,
+    ModelDescription,
+    ModelNotDownloaded,
+    models,
+)
+from app.tasks import tasks
+
+DATA = os.urandom(1024 * 1024)
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Serves DATA like the model host, with or without range requests"""
+
+    ranges_supported = True
+    # (start, end) of every range request, end inclusive
+    requested_ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(DATA)))
+        if self.ranges_supported:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if self.ranges_supported and match:
+            start, end = int(match[1]), int(match[2])
+            self.requested_ranges.append((start, end))
+            self.send_response(206)
+            body = DATA[start : end + 1]
+        else:
+            self.send_response(200)
+            body = DATA
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            # the client canceled the download
+            pass
+
+
+class ProgressTask:
+    """Collects progress like a DownloadModelTask, cancels after `cancel_after` bytes"""
+
+    def __init__(self, cancel_after=None):
+        self.total = 0
+        self.processed = 0
+        self.canceled = False
+        self.cancel_after = cancel_after
+        self.lock = threading.Lock()
+
+    def add_progress(self, added):
+        with self.lock:
+            self.processed += added
+            if self.cancel_after is not None and self.processed >= self.cancel_after:
+                self.canceled = True
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(StandInHandler, "ranges_supported", True)
+    monkeypatch.setattr(StandInHandler, "requested_ranges", [])
+    # small chunks, so the download can be canceled and resumed in between
+    monkeypatch.setattr(download, "CHUNK_SIZE", 16 * 1024)
+    monkeypatch.setattr(download, "SAVE_INTERVAL", 16 * 1024)
+    monkeypatch.setattr(download, "MIN_PARALLEL_SIZE", 0)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_resume_canceled_range_download(server, tmp_path):
+    path = tmp_path / "model.part"
+    first = PartialDownload(f"{server}/model.bin", path)
+    first.fetch(ProgressTask(cancel_after=len(DATA) // 2), connections=4)
+    assert not first.complete
+    assert first.state_path.exists()
+    fetched = sum(fetched for _, _, fetched in first.state["ranges"])
+    assert 0 < fetched < len(DATA)
+
+    # a new instance, like after a restart of the server
+    StandInHandler.requested_ranges.clear()
+    second = PartialDownload(f"{server}/model.bin", path)
+    task = ProgressTask()
+    second.fetch(task, connections=4)
+    assert second.complete
+    assert path.read_bytes() == DATA
+    assert task.processed == task.total == len(DATA)
+    # only the missing bytes were requested again
+    requested = sum(end + 1 - start for start, end in StandInHandler.requested_ranges)
+    assert requested == len(DATA) - fetched
+
+
+def test_single_stream_without_range_support(server, tmp_path):
+    StandInHandler.ranges_supported = False
+    path = tmp_path / "model.part"
+    partial = PartialDownload(f"{server}/model.bin", path)
+    task = ProgressTask()
+    partial.fetch(task, connections=4)
+    assert partial.complete
+    assert path.read_bytes() == DATA
+    assert task.processed == task.total == len(DATA)
+    assert not partial.state_path.exists()
+    assert StandInHandler.requested_ranges == []
+
+
+def download_model(url: str, sha256: str) -> ModelDescription:
+    model = ModelDescription(
+        name=f"test-{sha256[:8]}",
+        url=url,
+        description="",
+        size="1M",
+        type="transcription",
+        lang="Test",
+        sha256=sha256,
+    )
+    models.model_descriptions[model.model_id] = model
+    task = tasks.add(DownloadModelTask(model.model_id))
+    try:
+        models.download(model.model_id, task.uuid)
+    finally:
+        tasks.delete(task.uuid)
+        del models.model_descriptions[model.model_id]
+    return model
+
+
+def test_sha256_mismatch_rejects_file(server):
+    url = f"{server}/mismatch.bin"
+    with pytest.raises(ChecksumMismatch):
+        model = download_model(url, "0" * 64)
+    model = ModelDescription("test-00000000", url, "", "1M", "transcription", "Test")
+    assert not model.is_downloaded()
+    # the rejected file isn't kept for resuming either
+    assert list(DOWNLOAD_DIR.glob(f"{model.model_id}*")) == []
+
+
+def test_sha256_match_accepts_file(server):
+    model = download_model(f"{server}/match.bin", hashlib.sha256(DATA).hexdigest())
+    assert model.is_downloaded()
+    assert model.path().read_bytes() == DATA
+
+
+def test_languages_share_the_files_of_multilingual_models(server, monkeypatch):
+    listings = [
+        ModelDescription(
+            name="multilingual",
+            url=f"{server}/multilingual",
+            description="",
+            size="1M",
+            type="transcription",
+            lang=lang,
+            engine="faster-whisper",
+            engine_options={"language": lang[:2].lower()},
+            files=[f"{server}/multilingual/model.bin"],
+        )
+        for lang in ["German", "French"]
+    ]
+    for model in listings:
+        monkeypatch.setitem(models.model_descriptions, model.model_id, model)
+    german, french = listings
+
+    task = tasks.add(DownloadModelTask(german.model_id))
+    models.download(german.model_id, task.uuid)
+    assert german.is_downloaded() and not french.is_downloaded()
+    assert (german.path() / "model.bin").read_bytes() == DATA
+
+    # the files are there already, only the listing is marked as downloaded
+    StandInHandler.requested_ranges.clear()
+    task = tasks.add(DownloadModelTask(french.model_id))
+    models.download(french.model_id, task.uuid)
+    assert task.state == DownloadModelState.DONE
+    assert french.is_downloaded()
+    assert StandInHandler.requested_ranges == []
+    assert german.path() == french.path()
+
+    models.delete(german.model_id)
+    assert not german.is_downloaded() and french.is_downloaded()
+    assert (french.path() / "model.bin").exists()
+    models.delete(french.model_id)
+    assert not french.is_downloaded()
+    assert not french.path().exists()
+    with pytest.raises(ModelNotDownloaded):
+        models.delete(french.model_id)
+
+
+def test_failed_download_ends_in_failed_state(monkeypatch):
+    # nothing listens on port 1
+    model = ModelDescription(
+        "unreachable", "http://127.0.0.1:1/model.zip", "", "1M", "transcription", "Test"
+    )
+    monkeypatch.setitem(models.model_descriptions, model.model_id, model)
+    task = tasks.add(DownloadModelTask(model.model_id))
+    with pytest.raises(Exception):
+        models.download(model.model_id, task.uuid)
+    assert task.state == DownloadModelState.FAILED
+    assert task.error
+    assert not model.is_downloaded()
+    tasks.delete(task.uuid)
@@ -0,0 +1,61 @@
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app import diarize
+from app.metrics import measure, recording
+
+STAGE_TIME = 0.05
+
+
+def task():
+    return SimpleNamespace(timings={}, cpu_times={}, decoded_bytes=0)
+
+
+def slow(result):
+    def stage(*args):
+        time.sleep(STAGE_TIME)
+        return result
+
+    return stage
+
+
+def test_nested_phases_only_count_once():
+    recorded = task()
+    start = time.perf_counter()
+    with recording(recorded), measure("outer"):
+        time.sleep(STAGE_TIME)
+        with measure("inner"):
+            time.sleep(2 * STAGE_TIME)
+    elapsed = time.perf_counter() - start
+    assert recorded.timings["outer"] == pytest.approx(STAGE_TIME, abs=0.02)
+    assert recorded.timings["inner"] == pytest.approx(2 * STAGE_TIME, abs=0.02)
+    assert sum(recorded.timings.values()) == pytest.approx(elapsed, abs=0.01)
+
+
+def test_diarization_stages_are_nested_phases(monkeypatch):
+    diarizer = diarize.Diarizer()
+    frames = 1000
+    monkeypatch.setattr(
+        diarizer, "features", slow((np.ones((frames, 20)), np.ones(frames)))
+    )
+    monkeypatch.setattr(diarizer, "_acousting_processing", slow((None,) * 5))
+    monkeypatch.setattr(diarizer, "_binary_processing", slow(np.zeros((frames, 1))))
+    monkeypatch.setattr(
+        diarizer, "_resegmentation", slow((np.zeros((frames, 1)), None))
+    )
+    monkeypatch.setattr(diarize, "getSegments", lambda *args: [(0, 10, 1)])
+
+    recorded = task()
+    start = time.perf_counter()
+    with recording(recorded), measure("diarization"):
+        segments = diarizer.diarize_pcm(None)
+    elapsed = time.perf_counter() - start
+
+    assert [(s.start, s.length, s.speaker_id) for s in segments] == [(0, 10, 1)]
+    for stage in ["features", "binary_keys", "clustering", "resegmentation"]:
+        assert recorded.timings[f"diarization_{stage}"] >= STAGE_TIME
+    assert recorded.timings["diarization"] < STAGE_TIME
+    assert sum(recorded.timings.values()) == pytest.approx(elapsed, abs=0.01)
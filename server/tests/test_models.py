@@ -0,0 +1,118 @@
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app import engines
+from app import models as models_module
+from app.config import DATA_DIR
+from app.models import LoadedModel, ModelCache, Models, models
+
+
+def test_downloaded_index_ignores_other_files(monkeypatch):
+    model = models.available["English"].transcription_models[0]
+    model.path().mkdir()
+    models._refresh_downloaded()
+    assert model.model_id in models.downloaded
+
+    listings = []
+    listdir = os.listdir
+    monkeypatch.setattr(
+        models_module.os, "listdir", lambda path: listings.append(path) or listdir(path)
+    )
+    for i in range(10):
+        # like the journal of the task store, which lives in DATA_DIR as well
+        (DATA_DIR / f"other-{i}").write_bytes(b"")
+        assert model.model_id in models.downloaded
+    assert listings == []
+
+    models.delete(model.model_id)
+    assert model.model_id not in models.downloaded
+    assert len(listings) == 1
+
+
+@pytest.mark.parametrize("installed", [True, False])
+def test_models_of_missing_engines_are_hidden(monkeypatch, installed):
+    monkeypatch.setattr(engines.WhisperModel, "available", lambda: installed)
+    catalogue = Models()
+    listed = [
+        model
+        for language in catalogue.available.values()
+        for model in language.transcription_models
+    ]
+    whisper = [model for model in listed if model.engine == "faster-whisper"]
+    assert bool(whisper) == installed
+    assert all(model.model_id in catalogue.model_descriptions for model in listed)
+    assert all(
+        model.engine != "faster-whisper" or installed
+        for model in catalogue.model_descriptions.values()
+    )
+    assert any(model.engine == "vosk" for model in listed)
+
+
+def loaded(size):
+    return LoadedModel(model=object(), size=size, load_time=0)
+
+
+def test_model_cache_evicts_least_recently_used():
+    cache = ModelCache(budget=10, idle_timeout=0)
+    evicted = []
+    cache.evict_callbacks.append(evicted.append)
+    cache.put("a", loaded(4))
+    cache.put("b", loaded(4))
+    cache.get("a")
+    cache.put("c", loaded(4))
+    assert list(cache.entries) == ["a", "c"]
+    assert evicted == ["b"]
+    assert cache.stats()["a"]["hits"] == 1
+
+
+def test_model_cache_keeps_pinned_and_newest_models():
+    cache = ModelCache(budget=10, idle_timeout=0)
+    cache.put("a", loaded(4))
+    cache.pin("a")
+    # exceeds the budget on its own, but the newest model is kept
+    cache.put("b", loaded(20))
+    assert list(cache.entries) == ["a", "b"]
+    assert cache.stats()["a"]["in_use"]
+    cache.unpin("a")
+    assert list(cache.entries) == ["b"]
+
+
+def test_model_cache_evicts_idle_models():
+    cache = ModelCache(budget=100, idle_timeout=0.05)
+    cache.put("idle", loaded(1))
+    cache.put("pinned", loaded(1))
+    cache.pin("pinned")
+    time.sleep(0.1)
+    cache.put("used", loaded(1))
+    cache.evict_idle()
+    assert list(cache.entries) == ["pinned", "used"]
+
+
+def test_concurrent_gets_share_one_load():
+    catalogue = Models()
+    model = catalogue.available["English"].transcription_models[1]
+    model.path().mkdir()
+    loads = []
+
+    def load_model(description):
+        loads.append(description.model_id)
+        time.sleep(0.2)
+        return object()
+
+    catalogue._load_model = load_model
+    try:
+        with ThreadPoolExecutor(5) as executor:
+            results = list(
+                executor.map(lambda _: catalogue.get(model.model_id), range(5))
+            )
+    finally:
+        shutil.rmtree(model.path())
+    assert loads == [model.model_id]
+    assert all(result is results[0] for result in results)
+    stats = catalogue.load_stats[model.model_id]
+    assert (stats.loads, stats.waits) == (1, 4)
+    assert catalogue.loading == {}
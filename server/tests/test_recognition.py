@@ -0,0 +1,54 @@
+import threading
+
+from app.recognition import RecognitionPool, RecognitionService
+
+
+def test_jobs_take_turns():
+    pool = RecognitionPool(1)
+    started = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def blocker():
+        started.set()
+        release.wait()
+
+    pool.submit([blocker])
+    started.wait()
+    # both jobs wait while the only worker is busy
+    first = pool.submit([lambda i=i: order.append(("a", i)) for i in range(3)])
+    second = pool.submit([lambda i=i: order.append(("b", i)) for i in range(2)])
+    release.set()
+    for future in first + second:
+        future.result(timeout=5)
+    assert order == [("a", 0), ("b", 0), ("a", 1), ("b", 1), ("a", 2)]
+    pool.shutdown()
+
+
+def test_evicted_models_drop_their_pool():
+    service = RecognitionService(workers=2)
+    assert service.map("model", [lambda: 1, lambda: 2]) == [1, 2]
+    pool = service.pool("model")
+
+    service.evict("model")
+    for thread in pool.threads:
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+    assert "model" not in service.pools
+
+    # the model can be used again after it was loaded again
+    assert service.map("model", [lambda: 3]) == [3]
+    assert service.pool("model") is not pool
+    service.evict("model")
+    service.evict("unknown")
+
+
+def test_submitted_ranges_finish_after_shutdown():
+    pool = RecognitionPool(1)
+    release = threading.Event()
+    futures = pool.submit([release.wait, lambda: "done"])
+    pool.shutdown()
+    release.set()
+    assert futures[1].result(timeout=5) == "done"
+    pool.threads[0].join(timeout=5)
+    assert not pool.threads[0].is_alive()
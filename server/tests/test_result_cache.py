@@ -0,0 +1,117 @@
+import hashlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import result_cache
+from app.main import AUTH_TOKEN, app
+from app.result_cache import ResultCache, result_key
+from app.transcribe import rename_speakers, speaker_name
+
+
+def paragraph(speaker):
+    return {"speaker": speaker, "content": [{"type": "silence", "length": 1}]}
+
+
+def test_rename_speakers():
+    content = [
+        paragraph(speaker_name("a.wav", 1)),
+        paragraph(speaker_name("a.wav", 12)),
+        paragraph(speaker_name("a.wav")),
+    ]
+    renamed = rename_speakers(content, "a.wav", "b (1).mp3")
+    assert [p["speaker"] for p in renamed] == [
+        "Speaker 1 (b (1).mp3)",
+        "Speaker 12 (b (1).mp3)",
+        "b (1).mp3",
+    ]
+    assert [p["content"] for p in renamed] == [p["content"] for p in content]
+    # the cached content itself is left as it is
+    assert content[0]["speaker"] == "Speaker 1 (a.wav)"
+
+
+def test_rename_speakers_leaves_other_names():
+    content = [paragraph("Speaker 1 (a.wav.wav)"), paragraph("a")]
+    renamed = rename_speakers(content, "a.wav", "b.wav")
+    assert [p["speaker"] for p in renamed] == ["Speaker 1 (a.wav.wav)", "a"]
+
+
+def test_result_key_parameters():
+    key = result_key("hash", "model", True, 2)
+    assert result_key("hash", "model", True, 2) == key
+    assert result_key("other", "model", True, 2) != key
+    assert result_key("hash", "other", True, 2) != key
+    assert result_key("hash", "model", False, None) != key
+    assert result_key("hash", "model", True, 3) != key
+
+
+@pytest.mark.parametrize(
+    "setting, value",
+    [
+        ("VAD_GATING", "on"),
+        ("DIARIZATION_MODE", "pipelined"),
+        ("TRANSCRIPTION_CHUNK_LENGTH", 30.0),
+    ],
+)
+def test_result_key_settings(monkeypatch, setting, value):
+    key = result_key("hash", "model", True, None)
+    monkeypatch.setattr(result_cache, setting, value)
+    assert result_key("hash", "model", True, None) != key
+
+
+def test_result_cache_round_trip(tmp_path):
+    cache = ResultCache(tmp_path, 1024 * 1024)
+    value = {"file_name": "a.wav", "content": [paragraph("a.wav")]}
+    assert cache.get("key") is None
+    cache.put("key", value)
+    assert cache.get("key") == value
+    # the index is restored from the files
+    assert ResultCache(tmp_path, 1024 * 1024).get("key") == value
+
+
+def test_result_cache_disabled(tmp_path):
+    cache = ResultCache(tmp_path / "results", 0)
+    cache.put("key", {"file_name": "a.wav", "content": []})
+    assert cache.get("key") is None
+    assert not (tmp_path / "results").exists()
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    value = {"file_name": "a.wav", "content": [paragraph("a.wav")]}
+    cache = ResultCache(tmp_path, 1024 * 1024)
+    cache.put("size", value)
+    size = cache.entries["size"][0]
+
+    cache = ResultCache(tmp_path / "lru", 2 * size)
+    cache.put("a", value)
+    cache.put("b", value)
+    assert cache.get("a") == value
+    cache.put("c", value)
+    assert cache.get("b") is None
+    assert cache.get("a") == value and cache.get("c") == value
+    assert sorted(path.name for path in (tmp_path / "lru").iterdir()) == [
+        "a.json.gz",
+        "c.json.gz",
+    ]
+
+
+def test_cached_results_are_renamed_for_the_upload():
+    audio = b"the same audio"
+    content = [paragraph(speaker_name("first.wav", 1))]
+    key = result_key(hashlib.sha256(audio).hexdigest(), "model", True, None)
+    result_cache.result_cache.put(key, {"file_name": "first.wav", "content": content})
+
+    with TestClient(app) as client:
+        headers = {"Authorization": f"Bearer {AUTH_TOKEN}"}
+        response = client.post(
+            "/tasks/start_transcription/",
+            params={"transcription_model": "model", "diarize": True},
+            files={"file": ("upload", audio)},
+            data={"fileName": "second.wav"},
+            headers=headers,
+        )
+        task = response.json()
+        assert task["state"] == "done"
+        result = client.get(f"/tasks/{task['uuid']}/result/", headers=headers)
+        assert [p["speaker"] for p in result.json()] == ["Speaker 1 (second.wav)"]
+        client.delete(f"/tasks/{task['uuid']}/", headers=headers)
@@ -0,0 +1,82 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from app.scheduler import QueueFull, Scheduler
+
+
+def task(name):
+    return SimpleNamespace(uuid=name, queue_position=None)
+
+
+@pytest.fixture
+def blocked():
+    """A scheduler with one worker that is busy until `release` is set"""
+    scheduler = Scheduler(workers=1, max_queue=3, min_free_memory=0)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    scheduler.submit(task("blocker"), block)
+    started.wait()
+    yield scheduler, release
+    release.set()
+
+
+def run_queued(scheduler, release):
+    """Release the worker and wait until the queued jobs ran"""
+    done = threading.Semaphore(0)
+    queued = list(scheduler.queue)
+    for job in queued:
+        job.fn = lambda *args, fn=job.fn: (fn(*args), done.release())
+    release.set()
+    for _ in queued:
+        assert done.acquire(timeout=5)
+
+
+def test_priority_and_queue_positions(blocked):
+    scheduler, release = blocked
+    order = []
+    low, normal, high = task("low"), task("normal"), task("high")
+    scheduler.submit(low, order.append, "low", priority=-1)
+    scheduler.submit(normal, order.append, "normal")
+    assert (low.queue_position, normal.queue_position) == (1, 0)
+    scheduler.submit(high, order.append, "high", priority=1)
+    assert [t.queue_position for t in (low, normal, high)] == [2, 1, 0]
+
+    run_queued(scheduler, release)
+    assert order == ["high", "normal", "low"]
+    assert [t.queue_position for t in (low, normal, high)] == [None, None, None]
+
+
+def test_same_priority_runs_in_submission_order(blocked):
+    scheduler, release = blocked
+    order = []
+    for name in ["a", "b", "c"]:
+        scheduler.submit(task(name), order.append, name, priority=2)
+    run_queued(scheduler, release)
+    assert order == ["a", "b", "c"]
+
+
+def test_full_queue_rejects_jobs(blocked):
+    scheduler, release = blocked
+    for name in ["a", "b", "c"]:
+        scheduler.submit(task(name), lambda: None)
+    with pytest.raises(QueueFull):
+        scheduler.submit(task("d"), lambda: None)
+
+
+def test_discarded_jobs_update_positions(blocked):
+    scheduler, release = blocked
+    order = []
+    a, b, c = task("a"), task("b"), task("c")
+    for queued in [a, b, c]:
+        scheduler.submit(queued, order.append, queued.uuid)
+    scheduler.discard("b")
+    assert (a.queue_position, c.queue_position) == (0, 1)
+    run_queued(scheduler, release)
+    assert order == ["a", "c"]
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+from app.tasks import tasks
+from app.transcribe import TranscriptionState, TranscriptionTask
+
+
+def test_updates_are_coalesced():
+    async def run():
+        subscription = tasks.subscribe()
+        task = tasks.add(TranscriptionTask("a.wav", TranscriptionState.QUEUED))
+        try:
+            # adding a task wakes the subscriber right away
+            await asyncio.wait_for(subscription.wait(10), 1)
+            for progress in [0.1, 0.2, 0.3]:
+                task.progress = progress
+                task.notify_progress()
+            # progress alone doesn't wake the subscriber before the interval
+            start = time.monotonic()
+            await subscription.wait(0.1)
+            assert time.monotonic() - start >= 0.1
+            updated, deleted = subscription.take()
+            assert updated == [task] and deleted == set()
+            assert updated[0].progress == 0.3
+
+            task.state = TranscriptionState.TRANSCRIBING
+            await asyncio.wait_for(subscription.wait(10), 1)
+            task.progress = 0.4
+            tasks.delete(task.uuid)
+            await asyncio.wait_for(subscription.wait(10), 1)
+            # the update of a deleted task isn't sent anymore
+            assert subscription.take() == ([], {task.uuid})
+            assert subscription.take() == ([], set())
+        finally:
+            tasks.unsubscribe(subscription)
+            if task.uuid in tasks.tasks:
+                tasks.delete(task.uuid)
+
+    asyncio.run(run())
+
+
+def test_subscriptions_of_one_task():
+    async def run():
+        other = tasks.add(TranscriptionTask("other.wav", TranscriptionState.QUEUED))
+        task = tasks.add(TranscriptionTask("a.wav", TranscriptionState.QUEUED))
+        subscription = tasks.subscribe(task.uuid)
+        try:
+            other.state = TranscriptionState.DONE
+            tasks.delete(other.uuid)
+            task.state = TranscriptionState.DONE
+            await asyncio.wait_for(subscription.wait(10), 1)
+            assert subscription.take() == ([task], set())
+        finally:
+            tasks.unsubscribe(subscription)
+            tasks.delete(task.uuid)
+        assert subscription not in tasks.subscriptions
+
+    asyncio.run(run())
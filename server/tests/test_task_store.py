@@ -0,0 +1,71 @@
+from app.models import DownloadModelState, DownloadModelTask, PreloadModelTask
+from app.task_store import SqliteTaskStore
+from app.tasks import Tasks
+from app.transcribe import TranscriptionState, TranscriptionTask
+
+CONTENT = [{"speaker": "a.wav", "content": [{"type": "silence", "length": 1}]}]
+JOB = {"transcription_model": "model", "file_name": "a.wav", "priority": 0}
+
+
+def open_tasks(path) -> Tasks:
+    opened = Tasks()
+    # flushes are triggered by the tests
+    opened.open(SqliteTaskStore(path), flush_interval=3600)
+    return opened
+
+
+def test_tasks_survive_a_restart(tmp_path):
+    path = tmp_path / "tasks.sqlite3"
+    before = open_tasks(path)
+    done = before.add(TranscriptionTask("a.wav", TranscriptionState.QUEUED), JOB)
+    done.total = 10
+    done.timings = {"recognition": 1.5}
+    done.partial_content = [CONTENT[0]]
+    done.content = CONTENT
+    done.state = TranscriptionState.DONE
+    download = before.add(DownloadModelTask("model"))
+    download.state = DownloadModelState.FAILED
+    download.error = "unreachable"
+    deleted = before.add(TranscriptionTask("b.wav", TranscriptionState.QUEUED))
+    # preloads aren't persisted
+    before.add(PreloadModelTask("model"))
+    before.flush()
+    before.delete(deleted.uuid)
+    before.close()
+
+    after = open_tasks(path)
+    try:
+        assert set(after.tasks) == {done.uuid, download.uuid}
+        restored = after.get(done.uuid)
+        assert isinstance(restored, TranscriptionTask)
+        assert restored.state == TranscriptionState.DONE
+        assert (restored.filename, restored.total) == ("a.wav", 10)
+        assert restored.timings == {"recognition": 1.5}
+        # transient fields aren't stored, the content is loaded when it is used
+        assert restored.partial_content == []
+        assert restored.content is None
+        assert after.get_content(done.uuid) == CONTENT
+        assert after.jobs == {done.uuid: JOB}
+
+        restored_download = after.get(download.uuid)
+        assert restored_download.state == DownloadModelState.FAILED
+        assert restored_download.error == "unreachable"
+    finally:
+        after.close()
+
+
+def test_only_changed_tasks_are_written(tmp_path):
+    path = tmp_path / "tasks.sqlite3"
+    opened = open_tasks(path)
+    writes = []
+    write = opened.store.write
+    opened.store.write = lambda *args: writes.append(args) or write(*args)
+    try:
+        task = opened.add(TranscriptionTask("a.wav", TranscriptionState.QUEUED))
+        opened.flush()
+        opened.flush()
+        task.progress = 0.5
+        opened.flush()
+    finally:
+        opened.close()
+    assert [len(updated) for updated, _, _ in writes] == [1, 1]
@@ -0,0 +1,180 @@
+import math
+import sys
+import threading
+
+import pytest
+from pydiar.models import Segment
+
+from app import transcribe
+from app.audio import SAMPLE_RATE, SAMPLE_WIDTH, PcmBuffer
+from app.transcribe import TranscriptionState, TranscriptionTask
+
+
+def word(start, end, text="word"):
+    return {"start": start, "end": end, "word": text, "conf": 1.0}
+
+
+@pytest.fixture
+def silence():
+    pcm = PcmBuffer.from_chunks([bytes(200 * SAMPLE_RATE * SAMPLE_WIDTH)])
+    with pcm:
+        yield pcm
+
+
+def test_pipelined_paragraphs_tile_the_audio(monkeypatch, silence):
+    segments = [
+        Segment(start=0, length=50, speaker_id=1),
+        Segment(start=50, length=70, speaker_id=2),
+        Segment(start=120, length=80, speaker_id=1),
+    ]
+    words = [word(t, t + 0.8) for t in range(0, 49)]
+    # reaches into the previous segment, its center is in the second one
+    words.append(word(49.7, 50.6))
+    words += [word(t, t + 0.8) for t in range(51, 100)]
+    # recognized by two chunks that were split without a pause
+    words += [word(100, 101), word(100.5, 101.2)]
+    words += [word(t, t + 0.8) for t in range(102, 119)]
+    # reaches into the next segment, its center is in the second one
+    words.append(word(119.5, 120.3))
+    words += [word(t, t + 0.8) for t in range(121, 199)]
+    # runs past the end of the audio
+    words.append(word(199.5, 205))
+
+    monkeypatch.setattr(transcribe, "use_chunks", lambda duration: False)
+    monkeypatch.setattr(
+        transcribe, "diarize_pcm", lambda task, pcm, max_speakers, hash: segments
+    )
+    monkeypatch.setattr(
+        transcribe,
+        "recognize_ranges",
+        lambda task, model, model_id, pcm, ranges, executor, callbacks: [
+            {"result": words}
+        ],
+    )
+    task = TranscriptionTask("a.wav", TranscriptionState.QUEUED)
+    paragraphs = transcribe.transcribe_pipelined(
+        task, None, "model", silence, "a.wav", None
+    )
+
+    assert len(paragraphs) == len(segments)
+    for paragraph, segment in zip(paragraphs, segments):
+        position = segment.start
+        for item in paragraph["content"]:
+            assert item["sourceStart"] == pytest.approx(position)
+            assert item["length"] >= 0
+            position += item["length"]
+        assert position == pytest.approx(segment.start + segment.length)
+    total = sum(item["length"] for p in paragraphs for item in p["content"])
+    assert total == pytest.approx(silence.duration_seconds)
+    assert sum(
+        item["type"] == "word" for p in paragraphs for item in p["content"]
+    ) == len(words)
+
+
+def test_process_workers_reload_models_with_other_options(monkeypatch, silence):
+    loads = []
+    monkeypatch.setattr(
+        transcribe,
+        "load_model",
+        lambda engine, path, options: loads.append(options) or object(),
+    )
+    monkeypatch.setattr(transcribe, "recognize_range", lambda *args: {"result": []})
+    monkeypatch.setattr(transcribe, "_worker_model", None)
+    # the listings of a multilingual model share its path
+    for language in ["de", "de", "fr"]:
+        transcribe._recognize_segment(
+            "faster-whisper",
+            "/models/whisper",
+            {"language": language},
+            str(silence.path),
+            0,
+            1,
+        )
+    assert loads == [{"language": "de"}, {"language": "fr"}]
+
+
+def test_progress_of_parallel_ranges_adds_up():
+    task = TranscriptionTask("a.wav", TranscriptionState.TRANSCRIBING)
+    threads, updates = 8, 2000
+    task.total = threads * updates
+    workers = [
+        threading.Thread(
+            target=lambda: [task.set_transcription_progress(1) for _ in range(updates)]
+        )
+        for _ in range(threads)
+    ]
+    # switch threads as often as possible, so the updates interleave
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert task.processed == task.total
+    assert task.progress == 1
+
+
+def chunk_ranges(chunks):
+    return [
+        (chunk.start, chunk.end, chunk.decode_start, chunk.decode_end)
+        for chunk in chunks
+    ]
+
+
+def test_chunks_without_pauses_overlap(monkeypatch, silence):
+    monkeypatch.setattr(transcribe, "find_pause", lambda pcm, start, end: None)
+    chunks = transcribe.plan_chunks(silence, 60)
+    overlap = transcribe.CHUNK_OVERLAP
+    # the rest is shorter than 1.5 chunks, so it isn't split again
+    assert chunk_ranges(chunks) == [
+        (0, 60, 0, 60 + overlap),
+        (60, 120, 60 - overlap, 120 + overlap),
+        (120, 200, 120 - overlap, 200),
+    ]
+
+
+def test_chunks_are_split_in_pauses(monkeypatch, silence):
+    searched = []
+
+    def find_pause(pcm, start, end):
+        searched.append((start, end))
+        # only the search around the first boundary finds a pause
+        return start + 13 if len(searched) == 1 else None
+
+    monkeypatch.setattr(transcribe, "find_pause", find_pause)
+    chunks = transcribe.plan_chunks(silence, 60)
+    window = transcribe.CHUNK_PAUSE_SEARCH_WINDOW
+    overlap = transcribe.CHUNK_OVERLAP
+    assert searched == [(60 - window, 60 + window), (123 - window, 123 + window)]
+    assert chunk_ranges(chunks) == [
+        (0, 63, 0, 63),
+        (63, 123, 63, 123 + overlap),
+        (123, 200, 123 - overlap, 200),
+    ]
+
+
+def test_chunked_words_are_merged_without_repeats(monkeypatch, silence):
+    monkeypatch.setattr(transcribe, "TRANSCRIPTION_CHUNK_LENGTH", 60)
+    monkeypatch.setattr(transcribe, "find_pause", lambda pcm, start, end: None)
+
+    def recognize_ranges(task, model, model_id, pcm, ranges, executor, callbacks):
+        # a word at every full second of each range, relative to the range
+        return [
+            {
+                "result": [
+                    word(t - offset, t - offset + 0.5, str(t))
+                    for t in range(math.ceil(offset), math.ceil(offset + duration))
+                ]
+            }
+            for offset, duration in ranges
+        ]
+
+    monkeypatch.setattr(transcribe, "recognize_ranges", recognize_ranges)
+    task = TranscriptionTask("a.wav", TranscriptionState.TRANSCRIBING)
+    words = transcribe.recognize_chunked(task, None, "model", silence, "a.wav")
+    assert words == [word(t, t + 0.5, str(t)) for t in range(200)]
+    # the overlaps are recognized twice
+    assert task.total == 200 + 4 * transcribe.CHUNK_OVERLAP